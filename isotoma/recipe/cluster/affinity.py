@@ -0,0 +1,138 @@
+# Copyright 2010 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Pinning services to cpus, and spreading a cluster's services across cores and NUMA nodes.
+
+Python 2 has no os.sched_setaffinity, so the affinity is set by calling
+sched_setaffinity in the C library through ctypes. """
+
+import os
+
+
+SYSFS = "/sys/devices/system"
+
+
+def parse_cpus(text):
+    """ I turn a cpu list like 0-3,8 into a sorted list of cpu numbers """
+    cpus = set()
+    for part in text.replace(" ", ",").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def format_cpus(cpus):
+    """ I turn cpu numbers back into a cpu list like 0-3,8 """
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(a) if a == b else "%d-%d" % (a, b) for a, b in ranges)
+
+
+def _read(path):
+    try:
+        return open(path).read().strip()
+    except IOError:
+        return None
+
+
+def online_cpus():
+    """ I return the cpus that are online """
+    online = _read(os.path.join(SYSFS, "cpu", "online"))
+    if online:
+        return parse_cpus(online)
+    import multiprocessing
+    return range(multiprocessing.cpu_count())
+
+
+def numa_nodes():
+    """ I return the online cpus of each NUMA node. A machine without NUMA is a single node """
+    online = set(online_cpus())
+    nodes = []
+    try:
+        names = os.listdir(os.path.join(SYSFS, "node"))
+    except OSError:
+        names = []
+    numbers = sorted(int(name[4:]) for name in names if name.startswith("node") and name[4:].isdigit())
+    for number in numbers:
+        cpulist = _read(os.path.join(SYSFS, "node", "node%d" % number, "cpulist"))
+        cpus = [cpu for cpu in parse_cpus(cpulist or "") if cpu in online]
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [sorted(online)]
+
+
+def core(cpu):
+    """ I return which physical core a cpu is, as its package and core id. Without topology
+    information every cpu is taken for a core of its own """
+    topology = os.path.join(SYSFS, "cpu", "cpu%d" % cpu, "topology")
+    core_id = _read(os.path.join(topology, "core_id"))
+    if core_id is None:
+        return (None, cpu)
+    return (_read(os.path.join(topology, "physical_package_id")), core_id)
+
+
+def by_core(cpus):
+    """ I order cpus so the first thread of every core comes before the second thread of any """
+    cores = []
+    threads = {}
+    for cpu in cpus:
+        key = core(cpu)
+        if key not in threads:
+            cores.append(key)
+            threads[key] = []
+        threads[key].append(cpu)
+    order = []
+    for i in range(max(len(found) for found in threads.values())):
+        for key in cores:
+            if i < len(threads[key]):
+                order.append(threads[key][i])
+    return order
+
+
+def spread(count):
+    """ I return a cpu for each of count services.
+
+    Consecutive services go to different NUMA nodes, and within a node to different
+    physical cores, so SMT siblings are only shared once every core has a service.
+    When there are more services than cpus we go round again """
+    nodes = [by_core(node) for node in numa_nodes()]
+    order = []
+    for i in range(max(len(node) for node in nodes)):
+        for node in nodes:
+            if i < len(node):
+                order.append(node[i])
+    return [order[i % len(order)] for i in range(count)]
+
+
+def set_affinity(cpus, pid=0):
+    """ I restrict a process, by default the current one, to cpus """
+    import ctypes
+    from isotoma.recipe.cluster.events import libc, _check
+
+    # A cpu_set_t is a bitmask in an array of longs, and must be at least as big as the kernel's
+    bits = ctypes.sizeof(ctypes.c_ulong) * 8
+    mask = (ctypes.c_ulong * max(1024 / bits, max(cpus) / bits + 1))()
+    for cpu in cpus:
+        mask[cpu / bits] |= 1 << (cpu % bits)
+    _check(libc().sched_setaffinity(pid, ctypes.sizeof(mask), ctypes.byref(mask)))
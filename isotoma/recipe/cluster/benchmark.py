@@ -0,0 +1,141 @@
+# Copyright 2010 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Benchmarks for cluster control operations.
+
+I start clusters of synthetic services (see testservice.py) and time how long it
+takes to start, query, restart and stop them with each strategy. Run me with::
+
+    python -m isotoma.recipe.cluster.benchmark --services 1,10,100 --output results.json
+"""
+
+import os, sys, time, shutil, tempfile, optparse
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from isotoma.recipe.cluster.ctl import Services, ActionFailed
+
+
+STRATEGIES = {
+    "sequential": {"parallel": False},
+    "parallel": {"parallel": True},
+    }
+
+OPERATIONS = ("start", "status", "snapshot", "restart", "stop")
+
+
+def synthetic_services(directory, count, start_delay=0, stop_delay=0, fail_rate=0):
+    """ I return settings for count synthetic services that keep their pidfiles in directory """
+    testservice = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testservice.py")
+    flags = "--start-delay %s --stop-delay %s --fail-rate %s" % (start_delay, stop_delay, fail_rate)
+
+    services = []
+    for i in range(count):
+        name = "service%d" % i
+        pidfile = os.path.join(directory, "%s.pid" % name)
+        command = "%s %s %s %%s %s" % (sys.executable, testservice, pidfile, flags)
+        services.append({
+            "name": name,
+            "pidfile": pidfile,
+            "start-command": command % "start",
+            "stop-command": command % "stop",
+            "env": {"PYTHONPATH": os.pathsep.join(sys.path)},
+            })
+    return services
+
+
+class Quiet(object):
+
+    """ I throw away anything services print while they are being timed """
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def __exit__(self, exc_type, exc_value, tb):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        return False
+
+
+def measure(services, operation):
+    """ I run an operation on services and return how long it took and whether it worked """
+    started = time.time()
+    ok = True
+    with Quiet():
+        try:
+            getattr(services, operation)()
+        except ActionFailed:
+            ok = False
+    return {"seconds": round(time.time() - started, 4), "ok": ok}
+
+
+def run(count, strategy, start_delay=0, stop_delay=0, fail_rate=0):
+    """ I benchmark every operation on a cluster of count services using strategy """
+    directory = tempfile.mkdtemp(prefix="cluster-benchmark-")
+    settings = synthetic_services(directory, count, start_delay, stop_delay, fail_rate)
+    services = Services("", directory, settings, **STRATEGIES[strategy])
+
+    result = {
+        "services": count,
+        "strategy": strategy,
+        "start_delay": start_delay,
+        "stop_delay": stop_delay,
+        "fail_rate": fail_rate,
+        }
+    try:
+        for operation in OPERATIONS:
+            result[operation] = measure(services, operation)
+    finally:
+        # Make sure nothing is left running if the benchmark itself blew up
+        measure(services, "stop")
+        shutil.rmtree(directory)
+    return result
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--services", default="1,10,100",
+        help="comma separated cluster sizes to benchmark")
+    parser.add_option("-s", "--strategy", default=",".join(sorted(STRATEGIES)),
+        help="comma separated strategies to benchmark (%s)" % ", ".join(sorted(STRATEGIES)))
+    parser.add_option("--start-delay", type="float", default=0,
+        help="seconds each service takes to start")
+    parser.add_option("--stop-delay", type="float", default=0,
+        help="seconds each service takes to stop")
+    parser.add_option("--fail-rate", type="float", default=0,
+        help="chance, between 0 and 1, that a service fails to start")
+    parser.add_option("-o", "--output", default=None,
+        help="file to write the results to as JSON")
+    options, args = parser.parse_args()
+
+    results = []
+    for count in [int(n) for n in options.services.split(",")]:
+        for strategy in options.strategy.split(","):
+            result = run(count, strategy, options.start_delay, options.stop_delay, options.fail_rate)
+            print "%5d services, %-10s %s" % (count, strategy,
+                " ".join("%s=%.3fs" % (op, result[op]["seconds"]) for op in OPERATIONS))
+            results.append(result)
+
+    if options.output:
+        json.dump({"time": time.time(), "results": results}, open(options.output, "w"), indent=2, sort_keys=True)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
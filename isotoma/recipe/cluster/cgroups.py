@@ -0,0 +1,109 @@
+# Copyright 2010 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Putting services in their own cgroup v2 group, under a subtree that has been delegated to us """
+
+import os, errno
+
+
+# Service settings and the cgroup files they are written to
+LIMITS = (
+    ("memory-max", "memory.max"),
+    ("cpu-weight", "cpu.weight"),
+    ("io-weight", "io.weight"),
+    )
+
+CONTROLLERS = {
+    "memory.max": "memory",
+    "cpu.weight": "cpu",
+    "io.weight": "io",
+    }
+
+
+class Cgroup(object):
+
+    """ I am a cgroup v2 group for a service """
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, name, value, path=None):
+        fp = open(os.path.join(path or self.path, name), "w")
+        try:
+            fp.write("%s\n" % value)
+        finally:
+            fp.close()
+
+    def read(self, name):
+        try:
+            return open(os.path.join(self.path, name)).read().strip()
+        except IOError:
+            return None
+
+    def create(self, limits):
+        """ I create the group if needed and apply limits, a dict of cgroup file names and values """
+        parent = os.path.dirname(self.path)
+
+        controllers = set(CONTROLLERS[name] for name in limits)
+        if controllers:
+            # Let our children use the controllers. They may already be enabled, or the
+            # delegation may not allow it - in that case writing the limit will fail
+            try:
+                self.write("cgroup.subtree_control", " ".join("+" + c for c in sorted(controllers)), parent)
+            except IOError:
+                pass
+
+        try:
+            os.mkdir(self.path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        for name, value in limits.items():
+            self.write(name, value)
+
+    def attach(self, pid):
+        """ I move a process into the group. Its children will be born in it """
+        self.write("cgroup.procs", pid)
+
+    def stats(self):
+        """ I return the memory and cpu use of everything in the group """
+        stats = {"path": self.path}
+
+        current = self.read("memory.current")
+        if current and current.isdigit():
+            stats["memory_current"] = int(current)
+
+        maximum = self.read("memory.max")
+        if maximum:
+            stats["memory_max"] = int(maximum) if maximum.isdigit() else maximum
+
+        for line in (self.read("cpu.stat") or "").splitlines():
+            key, value = line.split()
+            if key in ("usage_usec", "user_usec", "system_usec"):
+                stats["cpu_" + key] = int(value)
+
+        return stats
+
+
+def get_limits(settings):
+    """ I return the cgroup files to write for a service's settings """
+    limits = {}
+    for key, name in LIMITS:
+        value = settings.get(key, "").strip()
+        if value:
+            if name == "io.weight" and value.isdigit():
+                value = "default %s" % value
+            limits[name] = value
+    return limits
@@ -12,12 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os, sys, subprocess, shlex, time, pwd, grp, ConfigParser
+# Keep imports here cheap: status and running are called by monitoring every few
+# seconds. Modules that are slow to import are imported by whatever needs them.
+import os, sys, errno, shlex, time, signal, pwd, grp, optparse
 
-try:
-    import simplejson as json
-except ImportError:
-    import json
+from isotoma.recipe.cluster.events import wait_for
+from isotoma.recipe.cluster import procfs
+from isotoma.recipe.cluster.timings import Timer, History, format_timing, summarise, json_module
 
 
 class NothingToDo(Exception):
@@ -28,6 +29,98 @@ class ActionFailed(Exception):
     pass
 
 
+def asbool(value):
+    """ I turn a buildout style boolean into a real one """
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("true", "yes", "on", "1")
+
+
+def get_signal(value):
+    """ I turn a signal name like TERM or SIGTERM, or a number, into a signal number """
+    value = str(value).strip().upper()
+    if value.isdigit():
+        return int(value)
+    if not value.startswith("SIG"):
+        value = "SIG" + value
+    if not hasattr(signal, value):
+        raise ActionFailed("Unknown signal '%s'" % value)
+    return getattr(signal, value)
+
+
+def dependency_waves(names, depends):
+    """ I arrange names into waves, where everything a name depends on is in an earlier wave.
+
+    depends maps a name to a list of the names it depends on. A name's wave is the length
+    of the longest chain of dependencies below it, so acting on each wave in turn takes as
+    long as the critical path. Within a wave names keep their original order. I raise
+    ValueError if a dependency is unknown or the dependencies form a cycle """
+    for name in names:
+        for dep in depends.get(name, []):
+            if dep not in names:
+                raise ValueError("'%s' depends on unknown service '%s'" % (name, dep))
+
+    depth = {}
+
+    def visit(name, path):
+        if name in depth:
+            return depth[name]
+        if name in path:
+            cycle = path[path.index(name):] + [name]
+            raise ValueError("Dependency cycle: %s" % " -> ".join(cycle))
+        deps = depends.get(name, [])
+        d = 0
+        if deps:
+            d = 1 + max(visit(dep, path + [name]) for dep in deps)
+        depth[name] = d
+        return d
+
+    for name in names:
+        visit(name, [])
+
+    waves = []
+    for name in names:
+        while len(waves) <= depth[name]:
+            waves.append([])
+        waves[depth[name]].append(name)
+    return waves
+
+
+def run_concurrently(action, services, limit=None):
+    """ I call action on every service at the same time, from a pool of at most limit threads.
+
+    With no limit every service gets a thread of its own. I wait for all of them to
+    finish and return a list of (service, exception) pairs, one for every call that raised """
+    import threading, Queue
+    results = []
+    queue = Queue.Queue()
+    for service in services:
+        queue.put(service)
+
+    def run():
+        while True:
+            try:
+                service = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                action(service)
+            except BaseException, e:
+                results.append((service, e))
+
+    threads = []
+    for i in range(min(limit or queue.qsize(), queue.qsize())):
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        t.join()
+
+    return results
+
+
 class BaseService(object):
 
     """ I am a service that has a pidfile and can report whether i am alive or not """
@@ -49,23 +142,340 @@ class BaseService(object):
 
     def alive(self):
         """ I check if my pid is alive """
-        pid = self.pid
+        return pid_alive(self.pid)
 
-        if not pid:
-            return False
 
-        # Try kill() with signal 0
-        # No exceptions means the pid is alive
-        #  Special case: if we dont have permissions, give up
-        try:
-            os.kill(pid, 0)
-            return True
-        except OSError, e:
-            if e.errno == 3:
-                if "No such process" in e.strerror:
-                    return False
-                raise SystemExit("We don't have permission to check the status of that pid")
+def pid_alive(pid):
+    """ I check if a pid is alive """
+    if not pid:
+        return False
+
+    # Try kill() with signal 0
+    # No exceptions means the pid is alive
+    #  Special case: if we dont have permissions, give up
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError, e:
+        if e.errno == 3:
+            if "No such process" in e.strerror:
+                return False
+            raise SystemExit("We don't have permission to check the status of that pid")
+    return False
+
+
+_users = {}
+
+def lookup_user(name):
+    """ I return the uid, gid, group ids and home directory of a user.
+
+    Each user is only looked up once per run, walking the group database is slow """
+    if name not in _users:
+        pw = pwd.getpwnam(name)
+        groups = set([pw.pw_gid])
+        groups.update(group.gr_gid for group in grp.getgrall() if name in group.gr_mem)
+        _users[name] = (pw.pw_uid, pw.pw_gid, sorted(groups), pw.pw_dir)
+    return _users[name]
+
+
+def switches_user(user):
+    """ I decide whether a command for user must run as someone else, and if so whether we can do it ourselves """
+    if not user:
         return False
+    return lookup_user(user)[0] != os.getuid()
+
+
+# Variables a command run as another user keeps from our environment, as sudo's
+# env_reset would leave them
+KEPT_ENVIRONMENT = ("PATH", "TERM", "LANG", "LANGUAGE", "TZ")
+
+
+def user_environment(user, env=None):
+    """ I return a minimal environment for a command run as user, with env on top.
+
+    Nothing else of ours is passed on, such as SSH_AUTH_SOCK or SUDO_USER """
+    result = dict((key, value) for key, value in os.environ.items()
+        if key in KEPT_ENVIRONMENT or key.startswith("LC_"))
+    result.setdefault("PATH", "/usr/local/bin:/usr/bin:/bin")
+    result.update({"HOME": lookup_user(user)[3], "USER": user, "LOGNAME": user})
+    if env:
+        result.update(env)
+    return result
+
+
+def drop_privileges(user):
+    """ I make the current process run as user. Only root can do this, and it can't be undone """
+    uid, gid, groups = lookup_user(user)[:3]
+    os.setgroups(groups)
+    os.setgid(gid)
+    os.setuid(uid)
+
+
+def set_cloexec(fd):
+    """ I stop fd being inherited by anything exec'd from now on """
+    import fcntl
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+def close_inherited_fds(keep=()):
+    """ I close every file descriptor above stderr except those in keep.
+
+    A forked child holds everything its parent had open, such as the supervisor's
+    sockets, and would pass them on to whatever it runs """
+    try:
+        fds = [int(fd) for fd in os.listdir("/proc/self/fd")]
+    except OSError:
+        import resource
+        fds = range(3, resource.getrlimit(resource.RLIMIT_NOFILE)[0])
+    for fd in fds:
+        if fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                # Including the descriptor listdir used, which is already closed
+                pass
+
+
+def daemonize(argv, env, pidfile, log=None, setup=None):
+    """ I run argv as a daemon, with no interpreter or wrapper script in between, and return its pid.
+
+    I double fork so the daemon is not our child and has no controlling terminal. The
+    daemon writes its pid to pidfile, runs setup and then execs argv. Its output is
+    piped to a process pumping it into log, a LogFile, or thrown away if there is no
+    log. I raise OSError if it couldn't be executed """
+    import cPickle
+
+    # The write end is closed by a successful exec, anything read from it is an error
+    r, w = os.pipe()
+    set_cloexec(w)
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(r)
+            os.setsid()
+            os.chdir("/")
+            null = os.open(os.devnull, os.O_RDWR)
+            os.dup2(null, 0)
+            out = null
+
+            if log:
+                pipe, out = os.pipe()
+                if os.fork() == 0:
+                    # The pump, which exits once everything writing to the pipe has.
+                    # It stays as us rather than the service's user, so it can rotate
+                    # logs in a directory the service can't write to
+                    try:
+                        os.dup2(null, 1)
+                        os.dup2(null, 2)
+                        close_inherited_fds(keep=(pipe,))
+                        log.pump(pipe)
+                    finally:
+                        os._exit(0)
+                os.close(pipe)
+
+            if os.fork() > 0:
+                os._exit(0)
+
+            os.dup2(out, 1)
+            os.dup2(out, 2)
+            close_inherited_fds(keep=(w,))
+
+            tmp = "%s.%d.tmp" % (pidfile, os.getpid())
+            open(tmp, "w").write("%d\n" % os.getpid())
+            os.rename(tmp, pidfile)
+
+            if setup:
+                setup()
+            if env is None:
+                os.execvp(argv[0], argv)
+            os.execvpe(argv[0], argv, env)
+        except EnvironmentError, e:
+            os.write(w, cPickle.dumps((e.errno, e.strerror, e.filename)))
+        except BaseException, e:
+            os.write(w, cPickle.dumps((None, str(e), None)))
+        os._exit(127)
+
+    os.close(w)
+    os.waitpid(pid, 0)
+    data = ""
+    while True:
+        chunk = os.read(r, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(r)
+
+    if data:
+        if os.path.exists(pidfile):
+            os.unlink(pidfile)
+        raise OSError(*cPickle.loads(data))
+
+    return int(open(pidfile).read())
+
+
+# The settings of a service that are used here. Only these are kept in the manifest.
+SERVICE_KEYS = (
+    "name", "start-command", "stop-command", "pidfile", "env", "user",
+    "barrier", "depends-on",
+    "ready-tcp", "ready-http", "ready-socket", "ready-timeout",
+    "drain-command", "drain-signal", "drain-timeout",
+    "stop-signal", "stop-timeout", "kill-timeout",
+    "restart-backoff", "max-restarts", "restart-window",
+    "adopt-cmdline", "adopt-port",
+    "cgroup-root", "memory-max", "cpu-weight", "io-weight",
+    "cpu-affinity",
+    "foreground-command", "daemonize", "output",
+    "log-dir", "log-max-bytes", "log-backups",
+    "hosts", "tags",
+    "settings-fingerprint",
+    )
+
+# Settings that only change how we control a service, not how it runs. Changing them
+# doesn't need the service to be restarted
+CONTROL_KEYS = (
+    "barrier", "depends-on",
+    "ready-tcp", "ready-http", "ready-socket", "ready-timeout",
+    "drain-command", "drain-signal", "drain-timeout",
+    "stop-command", "stop-signal", "stop-timeout", "kill-timeout",
+    "restart-backoff", "max-restarts", "restart-window",
+    "adopt-cmdline", "adopt-port",
+    "hosts", "tags",
+    "settings-fingerprint",
+    )
+
+
+def settings_fingerprint(settings):
+    """ I return a hash of every setting of a service that affects how it runs, including its command lines """
+    import hashlib
+    items = []
+    for key in sorted(settings):
+        if key in CONTROL_KEYS:
+            continue
+        value = settings[key]
+        if isinstance(value, dict):
+            value = sorted(value.items())
+        items.append((key, value))
+    return hashlib.sha1(repr(items)).hexdigest()[:16]
+
+MANIFEST_VERSION = 1
+
+
+def manifest_path(path):
+    return os.path.splitext(path)[0] + ".manifest"
+
+
+def write_manifest(path, config):
+    """ I write a precompiled copy of the cluster.cfg at path, holding only the settings we use.
+
+    config is the RawConfigParser that was written to path. The manifest records the size
+    and modification time of path, so a hand edited cluster.cfg makes it stale """
+    import marshal
+
+    cluster = dict(config.items('cluster'))
+    services = []
+    for section in cluster['services'].split():
+        services.append(dict((k, v) for k, v in config.items(section) if k in SERVICE_KEYS))
+
+    import hashlib
+    st = os.stat(path)
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "source": (st.st_size, st.st_mtime),
+        "hash": hashlib.sha1(open(path, "rb").read()).hexdigest(),
+        "cluster": cluster,
+        "services": services,
+        }
+    data = marshal.dumps(manifest)
+    try:
+        if open(manifest_path(path), "rb").read() == data:
+            return
+    except IOError:
+        pass
+    open(manifest_path(path), "wb").write(data)
+
+
+def read_manifest(path):
+    """ I return the cluster settings and service settings from the manifest for path, or None if it is missing or stale """
+    import marshal
+
+    try:
+        manifest = marshal.loads(open(manifest_path(path), "rb").read())
+        st = os.stat(path)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        return None
+    if manifest.get("source") != (st.st_size, st.st_mtime):
+        return None
+    return manifest["cluster"], manifest["services"]
+
+
+def read_config(path):
+    """ I return the cluster settings and service settings from cluster.cfg """
+    import ConfigParser
+
+    config = ConfigParser.RawConfigParser()
+    config.read(path)
+
+    cluster = dict(config.items('cluster'))
+    services = [dict(config.items(s)) for s in cluster['services'].strip().split(" ")]
+    return cluster, services
+
+
+def manifest_hash(path):
+    """ I return the hash of the cluster.cfg the manifest for path was made from, or None if there is no manifest """
+    import marshal
+    try:
+        return marshal.loads(open(manifest_path(path), "rb").read()).get("hash")
+    except (IOError, EOFError, ValueError, TypeError, AttributeError):
+        return None
+
+
+def load_config(path):
+    """ I load the cluster settings from the manifest if it is up to date, and from cluster.cfg if not """
+    return read_manifest(path) or read_config(path)
+
+
+class ServiceIndex(object):
+
+    """ I find services by name, by glob or by tag without touching anything but their settings.
+
+    A pattern starting with @ matches the services with that tag. A pattern with glob
+    characters in it matches against service names, and anything else is a name """
+
+    def __init__(self, services):
+        self.order = [service["name"] for service in services]
+        self.names = set(self.order)
+        self.tags = {}
+        for service in services:
+            for tag in service.get("tags", "").split():
+                self.tags.setdefault(tag, set()).add(service["name"])
+
+    def match(self, pattern):
+        """ I return the names of the services that pattern matches """
+        if pattern.startswith("@"):
+            return self.tags.get(pattern[1:], set())
+        if pattern in self.names:
+            return set([pattern])
+        if [c for c in "*?[" if c in pattern]:
+            import fnmatch
+            return set(name for name in self.order if fnmatch.fnmatchcase(name, pattern))
+        return set()
+
+    def select(self, patterns):
+        """ I return the names of the services matched by any of patterns, in the configured order """
+        selected = set()
+        unmatched = []
+        for pattern in patterns:
+            matched = self.match(pattern)
+            if not matched:
+                unmatched.append(pattern)
+            selected.update(matched)
+        if unmatched:
+            raise ActionFailed("No service matches %s" % ", ".join(unmatched))
+        return [name for name in self.order if name in selected]
 
 
 class Service(BaseService):
@@ -77,6 +487,15 @@ class Service(BaseService):
         self.varrundir = varrundir
         self.service = service
         self.settings = settings
+        self.timings = []
+        # The cluster I belong to, recorded with the settings I was started with
+        self.cluster = None
+        # The cpu given to me by auto-pin, if I don't have a cpu-affinity of my own
+        self.pinned_cpu = None
+
+    def timer(self, action):
+        """ I return a Timer whose finished record is added to my timings """
+        return Timer(self.service, action, self.timings.append)
 
     @property
     def start_command(self):
@@ -88,8 +507,28 @@ class Service(BaseService):
     def stop_command(self):
         if "stop-command" in self.settings:
             return self.settings["stop-command"]
+        if self.daemonize:
+            # We started it, so we stop it with stop-signal
+            return None
         return "%s stop" % os.path.join(self.bindir, self.service)
 
+    @property
+    def foreground_command(self):
+        if "foreground-command" in self.settings:
+            return self.settings["foreground-command"]
+        return "%s fg" % os.path.join(self.bindir, self.service)
+
+    @property
+    def daemonize(self):
+        """ I am True if ctl daemonizes my foreground command itself, rather than my start command doing it """
+        return self.settings.get("daemonize", "self").strip() == "ctl"
+
+    @property
+    def output(self):
+        if "output" in self.settings:
+            return self.settings["output"]
+        return os.path.join(self.settings.get("log-dir", "").strip() or self.varrundir, "%s.log" % self.service)
+
     @property
     def pidfile(self):
         if "pidfile" in self.settings:
@@ -106,15 +545,268 @@ class Service(BaseService):
     def user(self):
         return self.settings.get("user", None)
 
+    @property
+    def barrier(self):
+        return asbool(self.settings.get("barrier", "false"))
+
+    @property
+    def depends_on(self):
+        return self.settings.get("depends-on", "").split()
+
+    @property
+    def probes(self):
+        from isotoma.recipe.cluster.probes import get_probes
+        return get_probes(self.settings)
+
+    @property
+    def ready_timeout(self):
+        return float(self.settings.get("ready-timeout", 60))
+
+    @property
+    def cgroup(self):
+        root = self.settings.get("cgroup-root", "").strip()
+        if not root:
+            return None
+        from isotoma.recipe.cluster.cgroups import Cgroup
+        return Cgroup(os.path.join(root, self.service))
+
+    @property
+    def cpu_affinity(self):
+        """ I return the cpus my start command is restricted to, or None to leave it to the scheduler """
+        from isotoma.recipe.cluster.affinity import parse_cpus
+        if self.settings.get("cpu-affinity", "").strip():
+            return parse_cpus(self.settings["cpu-affinity"])
+        if self.pinned_cpu is not None:
+            return [self.pinned_cpu]
+        return None
+
+    def prepare_start(self):
+        """ I get things ready for the start command, and return a function to run in it just before it execs """
+        steps = []
+
+        cgroup = self.cgroup
+        if cgroup:
+            from isotoma.recipe.cluster.cgroups import get_limits
+            try:
+                cgroup.create(get_limits(self.settings))
+            except EnvironmentError, e:
+                raise ActionFailed("Could not set up cgroup %s: %s" % (cgroup.path, e))
+            steps.append(lambda: cgroup.attach(os.getpid()))
+
+        try:
+            cpus = self.cpu_affinity
+        except ValueError:
+            raise ActionFailed("cpu-affinity '%s' is not a list of cpus" % self.settings["cpu-affinity"].strip())
+        if cpus:
+            from isotoma.recipe.cluster.affinity import set_affinity, online_cpus, format_cpus
+            offline = set(cpus) - set(online_cpus())
+            if offline:
+                raise ActionFailed("cpu-affinity names cpus that aren't online: %s" % format_cpus(offline))
+            steps.append(lambda: set_affinity(cpus))
+
+        if not steps:
+            return None
+
+        def preexec():
+            for step in steps:
+                step()
+        return preexec
+
+    @property
+    def fingerprint_file(self):
+        return os.path.join(self.varrundir, "%s.fingerprint" % self.service)
+
+    def read_fingerprint(self):
+        """ I return the (pid, start time, command line hash) recorded when i was started, if there is one """
+        try:
+            pid, starttime, cmdhash = open(self.fingerprint_file).read().split()
+            return (int(pid), int(starttime), cmdhash)
+        except (IOError, ValueError):
+            return None
+
+    def write_fingerprint(self, pid):
+        """ I record what my process looks like so a reused pid can't be mistaken for it """
+        fingerprint = procfs.cache.fingerprint(pid)
+        if fingerprint:
+            open(self.fingerprint_file, "w").write("%d %d %s\n" % fingerprint)
+
+    def remove_fingerprint(self):
+        if os.path.exists(self.fingerprint_file):
+            os.unlink(self.fingerprint_file)
+
+    @property
+    def settings_fingerprint(self):
+        """ I am the hash of my settings worked out by buildout, which could see all of them """
+        return self.settings.get("settings-fingerprint") or settings_fingerprint(self.settings)
+
+    @property
+    def applied_file(self):
+        return os.path.join(self.varrundir, "%s.applied" % self.service)
+
+    def read_applied(self):
+        """ I return what was recorded about my settings when i was last started, if anything """
+        try:
+            return json_module().loads(open(self.applied_file).read())
+        except (IOError, ValueError):
+            return None
+
+    def write_applied(self):
+        """ I record the settings i was started with, so apply can tell if they have changed since """
+        settings = dict((key, value) for key, value in self.settings.items() if key in SERVICE_KEYS)
+        record = {"cluster": self.cluster, "fingerprint": self.settings_fingerprint, "settings": settings}
+        tmp = "%s.%d.tmp" % (self.applied_file, os.getpid())
+        open(tmp, "w").write(json_module().dumps(record, sort_keys=True))
+        os.rename(tmp, self.applied_file)
+
+    def remove_applied(self):
+        if os.path.exists(self.applied_file):
+            os.unlink(self.applied_file)
+
+    def is_mine(self, pid):
+        """ I check that pid is still the process i recorded when i started it.
+
+        If nothing was recorded for this pid, or /proc can't tell us, i assume it is """
+        recorded = self.read_fingerprint()
+        if not recorded or recorded[0] != pid:
+            return True
+        current = procfs.cache.fingerprint(pid)
+        return current is None or current == recorded
+
+    def alive(self):
+        """ I check if my pid is alive, and that it hasn't been reused by some other process """
+        pid = self.pid
+        return pid_alive(pid) and self.is_mine(pid)
+
+    @property
+    def adopt_cmdline(self):
+        if self.settings.get("adopt-cmdline", "").strip():
+            import re
+            return re.compile(self.settings["adopt-cmdline"].strip())
+        return None
+
+    @property
+    def adopt_port(self):
+        if self.settings.get("adopt-port", "").strip():
+            return int(self.settings["adopt-port"])
+        return None
+
+    @property
+    def adoptable(self):
+        return bool(self.adopt_cmdline or self.adopt_port)
+
+    def find_process(self, processes, ports):
+        """ I pick my process out of a scan of /proc, matching my adopt-cmdline and adopt-port.
+
+        If several processes match, the oldest wins - it is the one that forked the others """
+        pattern = self.adopt_cmdline
+        port = self.adopt_port
+        if not pattern and not port:
+            # Without either, every process would match
+            return None
+        ignore = (os.getpid(), os.getppid())
+
+        matches = []
+        for process in processes:
+            if process["pid"] in ignore:
+                continue
+            if pattern and not pattern.search(" ".join(process["cmdline"])):
+                continue
+            if port and port not in [ports.get(inode) for inode in process.get("sockets", ())]:
+                continue
+            matches.append(process)
+
+        if not matches:
+            return None
+        return min(matches, key=lambda process: (process["starttime"], process["pid"]))
+
+    def write_pidfile(self, pid):
+        """ I replace my pidfile, atomically so nothing ever sees half of it """
+        tmp = "%s.%d.tmp" % (self.pidfile, os.getpid())
+        open(tmp, "w").write("%d\n" % pid)
+        os.rename(tmp, self.pidfile)
+
+    @property
+    def drain_command(self):
+        return self.settings.get("drain-command", None)
+
+    @property
+    def drain_signal(self):
+        if "drain-signal" in self.settings:
+            return get_signal(self.settings["drain-signal"])
+        return None
+
+    @property
+    def drain_timeout(self):
+        return float(self.settings.get("drain-timeout", 30))
+
+    @property
+    def stop_signal(self):
+        return get_signal(self.settings.get("stop-signal", "TERM"))
+
+    @property
+    def stop_timeout(self):
+        return float(self.settings.get("stop-timeout", 60))
+
+    @property
+    def kill_timeout(self):
+        return float(self.settings.get("kill-timeout", 10))
+
     def get_command(self, command, user):
         cmd = []
 
-        if user and pwd.getpwnam(user).pw_uid != os.getuid():
+        # As root we switch user ourselves in the child, see spawn
+        if switches_user(user) and os.getuid() != 0:
             cmd = ["sudo", "-u", user]
 
         cmd.extend(shlex.split(command.encode("UTF-8")))
         return cmd
 
+    def child_setup(self, preexec=None):
+        """ I return the environment to run one of my commands in, and a function to run in the child before it execs.
+
+        When we are root there is no need for sudo: the child sets its groups and user
+        itself just before it execs. preexec is run in the child before that happens """
+        env = self.env
+        steps = [preexec] if preexec else []
+        if switches_user(self.user) and os.getuid() == 0:
+            env = user_environment(self.user, env)
+            steps.append(lambda: drop_privileges(self.user))
+
+        def run_steps():
+            for step in steps:
+                step()
+        return env, run_steps if steps else None
+
+    def spawn(self, command, preexec=None):
+        """ I start one of my commands as my user, and return the Popen for it.
+
+        If the command can't be run, or a step taken in the child before it execs
+        fails, Popen raises the child's error here and I raise ActionFailed """
+        import subprocess
+        env, setup = self.child_setup(preexec)
+        argv = self.get_command(command, self.user)
+        try:
+            return subprocess.Popen(argv, env=env, preexec_fn=setup, close_fds=True)
+        except EnvironmentError, e:
+            raise ActionFailed("Could not run %s: %s" % (argv[0], e))
+
+    def exec_foreground(self):
+        """ I daemonize my foreground command myself and exec it directly """
+        if switches_user(self.user) and os.getuid() != 0:
+            raise ActionFailed("daemonize = ctl needs to be run as root or as %s" % self.user)
+
+        from isotoma.recipe.cluster.logs import get_log
+        log = get_log(self.output, self.settings)
+
+        env, setup = self.child_setup(self.prepare_start())
+        argv = shlex.split(self.foreground_command.encode("UTF-8"))
+        try:
+            if not os.path.exists(os.path.dirname(log.path)):
+                os.makedirs(os.path.dirname(log.path))
+            daemonize(argv, env, self.pidfile, log, setup)
+        except EnvironmentError, e:
+            raise ActionFailed("Could not run %s: %s" % (argv[0], e.strerror))
+
     def start(self):
         """ I attempt to to start a service """
 
@@ -124,43 +816,129 @@ class Service(BaseService):
             raise NothingToDo("Service already running")
             return 1
 
-        p = subprocess.Popen(self.get_command(self.start_command, self.user), env=self.env)
-        p.wait()
-
-        if p.returncode != 0:
-            raise ActionFailed("Start script reported error")
-
-        for i in range(600):
-            time.sleep(0.1)
-            if self.alive():
-                return
-
-        if not self.alive():
-            raise ActionFailed("Could not start service")
+        # A bad readiness check has to be found before anything is launched
+        probes = self.probes
+
+        with self.timer("start") as timer:
+            if self.daemonize:
+                self.exec_foreground()
+                timer.mark("exec")
+            else:
+                p = self.spawn(self.start_command, self.prepare_start())
+                p.wait()
+                timer.mark("exec")
+
+                if p.returncode != 0:
+                    raise ActionFailed("Start script reported error")
+
+            if not wait_for(self.alive, 60, directory=os.path.dirname(self.pidfile)):
+                raise ActionFailed("Could not start service")
+            timer.mark("pidfile")
+            self.write_fingerprint(self.pid)
+
+            if probes:
+                if not wait_for(self.ready, self.ready_timeout, pid=self.pid):
+                    if not self.alive():
+                        raise ActionFailed("Service exited before it was ready")
+                    raise ActionFailed("Service did not become ready")
+                timer.mark("ready")
+
+        self.write_applied()
+
+    def send_signal(self, pid, signum):
+        """ I send a signal to my process, through kill(1) as my user if we aren't allowed to directly """
+        try:
+            os.kill(pid, signum)
+        except OSError, e:
+            if e.errno != errno.EPERM or not self.user:
+                raise
+            self.spawn("kill -%d %d" % (signum, pid)).wait()
+
+    def wait_for_exit(self, pid, timeout):
+        dead = lambda: not self.alive()
+        return wait_for(dead, timeout, directory=os.path.dirname(self.pidfile), pid=pid)
+
+    def drain(self, pid):
+        """ I ask my process to finish what it is doing and wait for it to exit, returning True if it did """
+        if self.drain_command:
+            self.spawn(self.drain_command).wait()
+        elif self.drain_signal:
+            self.send_signal(pid, self.drain_signal)
+        else:
+            return False
 
+        print "Draining %s for up to %ss" % (self.service, self.drain_timeout)
+        return self.wait_for_exit(pid, self.drain_timeout)
 
     def stop(self):
         """ I attempt to to stop a service """
 
-        print "Attempting to stop %s (pid=%s)" % (self.service, self.pid)
+        pid = self.pid
+        print "Attempting to stop %s (pid=%s)" % (self.service, pid)
 
         if not self.alive():
             raise NothingToDo("Service is already stopped")
 
-        p = subprocess.Popen(self.get_command(self.stop_command, self.user), env=self.env)
-        p.wait()
+        with self.timer("stop") as timer:
+            self.shutdown(pid, timer)
+
+        # We wrote the pidfile, so the process won't remove it
+        if self.daemonize and self.pid == pid:
+            os.unlink(self.pidfile)
+
+        self.remove_fingerprint()
+        self.remove_applied()
+
+    def shutdown(self, pid, timer):
+        """ I make my process exit.
+
+        If a drain command or signal is configured i drain first. Then the stop script is
+        run, and if the process is still there after stop-timeout it is sent stop-signal,
+        and then SIGKILL after kill-timeout. Without a stop script, as when ctl daemonized
+        the process, stop-signal is sent straight away """
+        if self.drain(pid):
+            timer.mark("drain")
+            return
+
+        if self.stop_command is not None:
+            p = self.spawn(self.stop_command)
+            p.wait()
+            timer.mark("exec")
 
-        if p.returncode != 0:
-            raise ActionFailed("Stop script reported error")
+            if p.returncode != 0:
+                print "Stop script reported error"
 
-        for i in range(600):
-            time.sleep(0.1)
-            if not self.alive():
+            if self.wait_for_exit(pid, self.stop_timeout):
+                timer.mark("exit")
                 return
+            timer.mark("stop-timeout")
 
-        if self.alive():
+        for signum, timeout in ((self.stop_signal, self.kill_timeout), (signal.SIGKILL, 5)):
+            print "%s still running, sending signal %d" % (self.service, signum)
+            try:
+                self.send_signal(pid, signum)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+            if self.wait_for_exit(pid, timeout):
+                timer.mark("signal-%d" % signum)
+                break
+        else:
             raise ActionFailed("Service wouldn't shut down")
 
+        # A killed process can't clean up after itself
+        if self.pid == pid and os.path.exists(self.pidfile):
+            os.unlink(self.pidfile)
+
+    def ready(self):
+        """ I check whether i am alive and all my readiness probes pass """
+        if not self.alive():
+            return False
+        for probe in self.probes:
+            if not probe():
+                return False
+        return True
+
     def status(self):
         pid = self.pid or "no pid"
         if self.alive():
@@ -171,36 +949,158 @@ class Service(BaseService):
             return False
 
 
+# How many services are acted on at once in parallel mode. Waiting on each service takes
+# an inotify instance of its own, and there are only 128 of those per user by default
+MAX_PARALLEL = 32
+
+
 class Services(object):
 
     """ I am a collection of services that can be start, stopped, restarted and query for their status as a group """
 
-    def __init__(self, bindir, varrundir, services):
+    def __init__(self, bindir, varrundir, services, parallel=False, adopt=False, auto_pin=False, cluster=None, max_parallel=MAX_PARALLEL):
+        self.bindir = bindir
+        self.varrundir = varrundir
+        self.cluster = cluster
         self.services = []
         for service in services:
             self.services.append(Service(bindir, varrundir, service["name"], service))
+            self.services[-1].cluster = cluster
+        self.known = set(service.service for service in self.services)
+        self.parallel = parallel
+        self.max_parallel = max_parallel
+        self.adopt_on_start = adopt
+        if auto_pin:
+            self.pin()
+
+    def select(self, names):
+        """ I return the services called names as a collection of their own.
+
+        The selection still knows every service in the cluster, so apply doesn't take the
+        rest for removed services """
+        import copy
+        selection = copy.copy(self)
+        selection.services = [service for service in self.services if service.service in names]
+        return selection
+
+    def pin(self):
+        """ I give each service without a cpu-affinity a cpu of its own, spread across cores and NUMA nodes.
+
+        Cpus are handed out in the configured order, so a service keeps its cpu as long as
+        the services before it don't change """
+        from isotoma.recipe.cluster.affinity import spread
+        for service, cpu in zip(self.services, spread(len(self.services))):
+            service.pinned_cpu = cpu
 
-    def start(self):
-        """ I start everything in the list of daemons """
-        for service in self.services:
+    @property
+    def waves(self):
+        """ I split the services into groups that can be acted on together.
+
+        The groups are the waves of the dependency graph formed by each service's
+        depends-on. In parallel mode a service with barrier set also depends on everything
+        configured before it, and everything configured after it depends on it. Without
+        parallel mode every service is a group of its own, in dependency order and
+        otherwise in the configured order. Dependencies on services that aren't in the
+        collection, because only some services were selected, are ignored """
+        names = [service.service for service in self.services]
+        byname = dict((service.service, service) for service in self.services)
+
+        depends = {}
+        barriers = []
+        for i, service in enumerate(self.services):
+            deps = [name for name in service.depends_on if name in byname]
+            if self.parallel:
+                deps.extend(names[:i] if service.barrier else barriers)
+                if service.barrier:
+                    barriers.append(service.service)
+            depends[service.service] = deps
+
+        try:
+            waves = dependency_waves(names, depends)
+        except ValueError, e:
+            raise ActionFailed(e.args[0])
+
+        if not self.parallel:
+            return [[byname[name]] for wave in waves for name in wave]
+        return [[byname[name] for name in wave] for wave in waves]
+
+    def run_wave(self, action, wave, skipped):
+        """ I call action on every service in a wave, concurrently if there is more than one.
+
+        Services that had nothing to do are reported as skipped. I return the services
+        whose action failed, along with the failure """
+        if len(wave) == 1:
             try:
-                service.start()
+                action(wave[0])
             except NothingToDo:
-                print "Skipped as already running"
+                print skipped
+            except ActionFailed, e:
+                return [(wave[0], e)]
+            return []
+
+        failures = []
+        for service, e in run_concurrently(action, wave, self.max_parallel):
+            if isinstance(e, NothingToDo):
+                print "%s: %s" % (service.service, skipped)
+            elif isinstance(e, ActionFailed):
+                failures.append((service, e))
+            else:
+                raise e
+        return failures
+
+    def adopt(self):
+        """ I look for services that are running but whose pidfile is missing or stale, and fix their pidfiles.
+
+        Processes are found by their command line or listening port using a single scan of
+        /proc for the whole cluster. I return the services that were adopted """
+        candidates = [service for service in self.services if service.adoptable and not service.alive()]
+        if not candidates:
+            return []
+
+        need_ports = [service for service in candidates if service.adopt_port]
+        processes = procfs.scan(sockets=bool(need_ports))
+        ports = procfs.listening_ports() if need_ports else {}
+
+        adopted = []
+        for service in candidates:
+            process = service.find_process(processes, ports)
+            if not process:
+                continue
+
+            # Make sure the pid wasn't reused since the scan
+            stat = procfs.process_stat(process["pid"])
+            if not stat or stat["starttime"] != process["starttime"]:
+                continue
+
+            print "Adopting %s (pid=%s)" % (service.service, process["pid"])
+            service.write_pidfile(process["pid"])
+            service.write_fingerprint(process["pid"])
+            adopted.append(service)
+        return adopted
+
+    def start(self):
+        """ I start everything in the list of daemons, a wave at a time """
+        if self.adopt_on_start:
+            self.adopt()
+
+        for wave in self.waves:
+            failures = self.run_wave(lambda s: s.start(), wave, "Skipped as already running")
+            if len(wave) == 1 and failures:
+                raise failures[0][1]
+            if failures:
+                for service, e in failures:
+                    print "%s: %s" % (service.service, e.args[0])
+                raise ActionFailed("Not all services started")
 
     def stop(self):
         """ I reverse the list of daemons, then stop everything """
         errorflag = False
 
-        services = self.services[:]
-        services.reverse()
-        for service in services:
-            try:
-                service.stop()
-            except NothingToDo:
-                # if service is already stopped, we just carry on
-                print "Skipped as already stopped"
-            except ActionFailed, e:
+        waves = self.waves[:]
+        waves.reverse()
+        for wave in waves:
+            failures = self.run_wave(lambda s: s.stop(), wave, "Skipped as already stopped")
+            for service, e in failures:
                 print e.args[0]
                 errorflag = True
 
@@ -212,6 +1112,99 @@ class Services(object):
         self.stop()
         self.start()
 
+    def applied_services(self):
+        """ I return every service of this cluster that has a record of being started, including ones that have since been removed """
+        import glob
+        services = []
+        for path in sorted(glob.glob(os.path.join(self.varrundir, "*.applied"))):
+            try:
+                record = json_module().loads(open(path).read())
+            except (IOError, ValueError):
+                continue
+            if record.get("cluster") != self.cluster:
+                continue
+            name = os.path.basename(path)[:-len(".applied")]
+            service = Service(self.bindir, self.varrundir, name, record["settings"])
+            service.cluster = self.cluster
+            services.append(service)
+        return services
+
+    def apply(self):
+        """ I bring the running services into line with the configuration.
+
+        Services that have been removed are stopped, services that aren't running are
+        started and services whose settings have changed since they were started are
+        restarted, in dependency order. Everything else is left alone """
+        failed = False
+        removed = 0
+
+        for service in self.applied_services():
+            if service.service in self.known:
+                continue
+            if not service.alive():
+                service.remove_applied()
+                continue
+            print "%s has been removed" % service.service
+            removed += 1
+            try:
+                service.stop()
+            except ActionFailed, e:
+                print "%s: %s" % (service.service, e.args[0])
+                failed = True
+
+        plan = {}
+        for service in self.services:
+            if not service.alive():
+                plan[service] = "start"
+                continue
+            applied = service.read_applied()
+            if applied is None:
+                print "%s was started before its settings were recorded, restart it to apply any changes" % service.service
+            elif applied["fingerprint"] != service.settings_fingerprint:
+                plan[service] = "restart"
+
+        def apply_one(service):
+            if plan.get(service) == "restart":
+                print "%s has changed" % service.service
+                service.stop()
+                service.start()
+            elif plan.get(service) == "start":
+                service.start()
+
+        for wave in self.waves:
+            for service, e in self.run_wave(apply_one, wave, "Skipped as already running"):
+                print "%s: %s" % (service.service, e.args[0])
+                failed = True
+
+        if failed:
+            raise ActionFailed("Not all changes were applied")
+        if not plan and not removed:
+            raise NothingToDo("Every service is up to date")
+
+    def rolling_restart(self, batch_size=1):
+        """ I restart the daemons a batch at a time, in dependency order.
+
+        Each batch is stopped, started and checked to be ready before the next batch is
+        touched, so the rest of the cluster keeps serving. If a batch fails I stop there """
+        order = [service for wave in self.waves for service in wave]
+        batch_size = max(1, batch_size)
+
+        for i in range(0, len(order), batch_size):
+            batch = order[i:i+batch_size]
+            names = ", ".join(service.service for service in batch)
+            print "Restarting %s" % names
+
+            failures = self.run_wave(lambda s: s.stop(), batch, "Skipped as already stopped")
+            failures.extend(self.run_wave(lambda s: s.start(), batch, "Skipped as already running"))
+            for service, e in failures:
+                print "%s: %s" % (service.service, e.args[0])
+            if failures:
+                raise ActionFailed("Rolling restart aborted at %s" % names)
+
+            not_ready = [service.service for service in batch if not service.ready()]
+            if not_ready:
+                raise ActionFailed("Rolling restart aborted, %s not ready" % ", ".join(not_ready))
+
     def status(self):
         """ I iterate a dictionary of daemon information and get status info """
         not_running = 0
@@ -220,20 +1213,177 @@ class Services(object):
                 not_running += 1
         return not_running
 
+    def collect_timings(self):
+        """ I return the timings recorded by every service since i was last asked, oldest first """
+        timings = []
+        for service in self.services:
+            timings.extend(service.timings)
+            del service.timings[:]
+        timings.sort(key=lambda timing: timing["time"])
+        return timings
+
+    def stats(self, history):
+        """ I print start and stop latency percentiles for each service from a timings history """
+        summary = summarise(history.read())
+        if not summary:
+            print "No timings recorded yet."
+            return
+
+        print "%-20s %-6s %6s %8s %8s %8s" % ("service", "action", "count", "p50", "p95", "max")
+        names = [service.service for service in self.services]
+        for (name, action), stats in sorted(summary.items(), key=lambda item: (name_order(names, item[0][0]), item[0][1])):
+            print "%-20s %-6s %6d %7.3fs %7.3fs %7.3fs" % (name, action, stats["count"], stats["p50"], stats["p95"], stats["max"])
+
+    def snapshot(self):
+        """ I gather the state of every service in a single pass.
+
+        Each pidfile is read once and liveness is checked against one listing of /proc.
+        For each running service I include its uptime, cpu time and rss """
+        if procfs.available():
+            running = procfs.running_pids()
+            alive = lambda pid: pid in running
+        else:
+            alive = pid_alive
+
+        now = time.time()
+        snapshot = []
+        for service in self.services:
+            pid = service.pid
+            state = {"name": service.service, "pid": pid, "alive": bool(pid and alive(pid) and service.is_mine(pid))}
+            if state["alive"]:
+                info = procfs.process_info(pid, now)
+                if info:
+                    state.update(info)
+                cpus = procfs.cpus_allowed(pid)
+                if cpus:
+                    state["cpus_allowed"] = cpus
+            cgroup = service.cgroup
+            if cgroup:
+                state["cgroup"] = cgroup.stats()
+            snapshot.append(state)
+        return snapshot
+
+    def logs(self, name, lines=10, follow=False):
+        """ I print the end of a service's log, and with follow everything written to it until interrupted """
+        for service in self.services:
+            if service.service == name:
+                break
+        else:
+            raise ActionFailed("There is no service called %s" % name)
+
+        if not os.path.exists(service.output):
+            raise ActionFailed("%s has no log at %s" % (name, service.output))
+
+        from isotoma.recipe.cluster.logs import follow as follow_log
+        try:
+            follow_log(service.output, lines, follow)
+        except KeyboardInterrupt:
+            pass
+
+    def status_json(self):
+        """ I print the state of every service as JSON and return how many aren't running """
+        snapshot = self.snapshot()
+        not_running = len([state for state in snapshot if not state["alive"]])
+        json = json_module()
+        print json.dumps({"services": snapshot, "not_running": not_running}, sort_keys=True, indent=2)
+        return not_running
+
+
+def name_order(names, name):
+    """ I sort services in the configured order, with ones that have since been removed last """
+    if name in names:
+        return (0, names.index(name))
+    return (1, name)
+
+
+def supervised(client, command, json_output=False, services=None, **options):
+    """ I hand a command to a running supervisor and report what it said.
+
+    With services, a list of names, the supervisor only acts on those """
+    if services is not None:
+        options["services"] = services
+    response = client.request(command, **options)
+
+    if "error" in response:
+        raise ActionFailed(response["error"])
+    if "nothing_to_do" in response:
+        raise NothingToDo(response["nothing_to_do"])
+
+    if command == "metrics":
+        sys.stdout.write(response["metrics"])
+        return
+
+    if command != "status":
+        return
+
+    if json_output:
+        print json_module().dumps(response, sort_keys=True, indent=2)
+    else:
+        for state in response["services"]:
+            if state["alive"]:
+                print "'%s' is alive (%s)." % (state["name"], state["pid"])
+            elif state.get("failed"):
+                print "'%s' has failed, it kept on exiting." % state["name"]
+            else:
+                print "'%s' is not running." % state["name"]
+    return response["not_running"]
+
+
+ACTIONS = "start|stop|restart|rolling-restart|apply|status|running|supervise|stats|metrics|adopt|logs"
+
+
+def local_services(config, svcinf, local=False):
+    """ I return the services that run on this host. With local, that is all of them """
+    if not local:
+        svcinf = [service for service in svcinf if not service.get("hosts", "").strip()]
+    # Every service here is given its cpu before any narrowing to a selection, so a
+    # service is pinned to the same cpu however it was picked
+    return Services(config['bindir'], config['varrundir'], svcinf,
+        parallel=asbool(config.get('parallel', 'false')),
+        adopt=asbool(config.get('adopt', 'false')),
+        auto_pin=asbool(config.get('auto-pin', 'false')),
+        cluster=config['name'],
+        max_parallel=int(config.get('max-parallel', MAX_PARALLEL)))
+
+
+# The actions a running supervisor carries out in place of the cluster script
+SUPERVISED = ("start", "stop", "restart", "rolling-restart", "apply", "status", "running", "metrics")
+
 
 def main(path):
-    if len(sys.argv) != 2:
+    name = os.path.basename(sys.argv[0])
+
+    parser = optparse.OptionParser(usage="%%prog (%s) [service|glob|@tag ...]" % ACTIONS)
+    parser.add_option("-b", "--batch-size", type="int", default=None,
+        help="number of services to restart at a time in a rolling restart")
+    parser.add_option("-j", "--json", action="store_true", default=False,
+        help="print status as JSON")
+    parser.add_option("-t", "--timings", action="store_true", default=False,
+        help="print how long each phase of starting and stopping took")
+    parser.add_option("-f", "--follow", action="store_true", default=False,
+        help="keep printing a service's log as it is written")
+    parser.add_option("-n", "--lines", type="int", default=10,
+        help="number of lines of a service's log to print")
+    parser.add_option("-s", "--service", action="append", dest="services", default=[],
+        help="only act on the services this name, glob or @tag matches, can be given more than once")
+    parser.add_option("-l", "--local", action="store_true", default=False,
+        help="only act on services on this host, ignoring their hosts setting")
+    options, args = parser.parse_args()
+
+    if not args or (args[0] == "logs" and len(args) != 2):
         return 1
 
-    config = ConfigParser.RawConfigParser()
-    config.read(path)
+    # Anything after the action picks the services to act on, as --service does
+    patterns = options.services
+    if args[0] != "logs":
+        patterns = patterns + args[1:]
 
-    user = config.get('cluster', 'user')
-    owner = config.get('cluster', 'owner')
-    bindir = config.get('cluster', 'bindir')
-    varrundir = config.get('cluster', 'varrundir')
+    config, svcinf = load_config(path)
 
-    svcinf = [dict(config.items(s)) for s in config.get('cluster', 'services').strip().split(" ")]
+    cluster = config['name']
+    user = config['user']
+    owner = config['owner']
+    varrundir = config['varrundir']
 
     if len(user.strip()) > 0 and user != pwd.getpwuid(os.getuid()).pw_name:
         print >>sys.stderr, "Only '%s' is allowed to run this script" % user
@@ -244,27 +1394,121 @@ def main(path):
         os.chown(varrundir, pwd.getpwnam(owner).pw_uid, grp.getgrnam(owner).gr_gid)
         os.chmod(varrundir, 0755)
 
-    services = Services(bindir, varrundir, svcinf)
+    batch_size = options.batch_size
+    if batch_size is None:
+        batch_size = int(config.get('rolling-batch-size', 1))
+
+    selected = None
+    if patterns:
+        try:
+            selected = ServiceIndex(svcinf).select(patterns)
+        except ActionFailed, e:
+            print >>sys.stderr, e.args[0]
+            return 1
+
+    remote = None
+    waves = None
+    if not options.local and [service for service in svcinf if service.get("hosts", "").strip()]:
+        from isotoma.recipe.cluster.remote import split_hosts, host_waves, SshPool, RemoteHosts
+        picked = svcinf
+        if selected is not None:
+            picked = [service for service in svcinf if service["name"] in selected]
+        hosts = split_hosts(picked)[1]
+        if hosts:
+            script = config.get("remote-script", "").strip() or os.path.abspath(sys.argv[0])
+            remote = RemoteHosts(SshPool(config.get("ssh", "ssh")), script, hosts)
+            try:
+                waves = host_waves(picked)
+            except ActionFailed, e:
+                print >>sys.stderr, e.args[0]
+                return 1
+
+    services = local_services(config, svcinf, options.local)
+    if selected is not None:
+        services = services.select(selected)
+    history = History(os.path.join(varrundir, "%s.timings" % cluster))
+
+    socket_path = os.path.join(varrundir, "%s.sock" % cluster)
 
     try:
-        if sys.argv[1] == "start":
+        client = None
+        if args[0] in SUPERVISED and os.path.exists(socket_path):
+            from isotoma.recipe.cluster import supervisor
+            client = supervisor.connect(socket_path)
+
+        if remote and args[0] in remote.actions:
+            from isotoma.recipe.cluster.remote import control
+            status = control(args[0], services, remote, options.json, batch_size, client, waves)
+            if args[0] == "running":
+                sys.exit(status)
+            return status
+
+        # The supervisor is only told which services to act on when some were picked
+        names = None
+        if selected is not None:
+            names = [service.service for service in services.services]
+
+        if client and args[0] == "running":
+            sys.exit(supervised(client, "status", services=names))
+        elif client and args[0] == "rolling-restart":
+            return supervised(client, args[0], services=names, batch_size=batch_size)
+        elif client:
+            return supervised(client, args[0], options.json, names)
+        elif args[0] == "supervise":
+            from isotoma.recipe.cluster import supervisor
+            metrics_address = None
+            if config.get("metrics-listen", "").strip():
+                from isotoma.recipe.cluster.metrics import parse_address
+                metrics_address = parse_address(config["metrics-listen"])
+            reload = lambda: local_services(*load_config(path), local=options.local)
+            daemon = supervisor.Supervisor(services, socket_path, history=history,
+                metrics_address=metrics_address, metrics_interval=float(config.get("metrics-interval", 5)),
+                reload=reload)
+            def shutdown(signum, frame):
+                daemon.running = False
+            signal.signal(signal.SIGTERM, shutdown)
+            signal.signal(signal.SIGINT, shutdown)
+            return daemon.serve()
+        elif args[0] == "start":
             return services.start()
-        elif sys.argv[1] == "stop":
+        elif args[0] == "stop":
             return services.stop()
-        elif sys.argv[1] == "restart":
+        elif args[0] == "restart":
             return services.restart()
-        elif sys.argv[1] == "status":
+        elif args[0] == "rolling-restart":
+            return services.rolling_restart(batch_size)
+        elif args[0] == "apply":
+            return services.apply()
+        elif args[0] == "status" and options.json:
+            return services.status_json()
+        elif args[0] == "status":
             return services.status()
-        elif sys.argv[1] == "running":
+        elif args[0] == "running":
             sys.exit(services.status())
+        elif args[0] == "stats":
+            return services.stats(history)
+        elif args[0] == "metrics":
+            from isotoma.recipe.cluster.metrics import Collector
+            sys.stdout.write(Collector(services, history).render())
+            return
+        elif args[0] == "logs":
+            return services.logs(args[1], options.lines, options.follow)
+        elif args[0] == "adopt":
+            if not services.adopt():
+                raise NothingToDo("No running services without a pidfile were found")
+            return
     except NothingToDo, e:
         print >>sys.stderr, "Nothing To Do:", e.args[0]
         sys.exit(0)
     except ActionFailed, e:
         print >>sys.stderr, "Action Failed:", e.args[0]
         sys.exit(1)
-
-    print >>sys.stderr, "%s (start|stop|restart|status|running)" % name
+    finally:
+        timings = services.collect_timings()
+        history.append(timings)
+        if options.timings:
+            for timing in timings:
+                print format_timing(timing)
+
+    print >>sys.stderr, "%s (%s)" % (name, ACTIONS)
     sys.exit(0)
-
-
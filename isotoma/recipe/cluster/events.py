@@ -0,0 +1,176 @@
+# Copyright 2010 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Waiting for pidfiles to appear and processes to exit without busy polling.
+
+On Linux a directory is watched with inotify and a process with a pidfd, both
+through ctypes. Anywhere those aren't available we fall back to polling with an
+exponential backoff. """
+
+import os, errno, select, time
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# pidfd_open has the same number on every architecture
+SYS_pidfd_open = 434
+
+
+_libc = None
+
+def libc():
+    """ I load the C library once. ctypes is only imported when it is first needed """
+    global _libc
+    if _libc is None:
+        import ctypes
+        try:
+            _libc = ctypes.CDLL("libc.so.6", use_errno=True)
+        except OSError:
+            # find_library is slow, so only use it when the usual name doesn't work
+            import ctypes.util
+            _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return _libc
+
+
+def _check(result):
+    if result < 0:
+        import ctypes
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return result
+
+
+class DirectoryWatch(object):
+
+    """ I am an inotify watch on a directory. I become readable when a file in it is created, written, moved or deleted """
+
+    once = False
+
+    def __init__(self, path):
+        c = libc()
+        if not hasattr(c, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self.fd = _check(c.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        try:
+            _check(c.inotify_add_watch(self.fd, path or ".", WATCH_MASK))
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def fileno(self):
+        return self.fd
+
+    def drain(self):
+        """ I throw away any pending events - we only care that something happened """
+        while True:
+            try:
+                if not os.read(self.fd, 4096):
+                    return
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                raise
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ProcessWatch(object):
+
+    """ I am a pidfd for a process. I become readable when it exits """
+
+    once = True
+
+    def __init__(self, pid):
+        self.fd = _check(libc().syscall(SYS_pidfd_open, int(pid), 0))
+
+    def fileno(self):
+        return self.fd
+
+    def drain(self):
+        pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+def wait_for(predicate, timeout, directory=None, pid=None, interval=0.01, max_interval=1.0):
+    """ I wait until predicate() is true or timeout seconds have passed, and return its last result.
+
+    If directory is given I wake up whenever something in it changes, and if pid is given I
+    wake up when that process exits. Between wake ups predicate is rechecked with an
+    exponential backoff starting at interval, which is all that happens if neither watch
+    could be set up """
+    watches = []
+    if directory is not None:
+        try:
+            watches.append(DirectoryWatch(directory))
+        except (OSError, AttributeError):
+            pass
+    if pid:
+        try:
+            watches.append(ProcessWatch(pid))
+        except (OSError, AttributeError):
+            pass
+
+    try:
+        poller = select.poll()
+        for watch in watches:
+            poller.register(watch.fileno(), select.POLLIN)
+
+        deadline = time.time() + timeout
+        while True:
+            result = predicate()
+            if result:
+                return result
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return predicate()
+
+            delay = min(remaining, interval)
+            interval = min(interval * 2, max_interval)
+
+            if not watches:
+                time.sleep(delay)
+                continue
+
+            try:
+                ready = poller.poll(delay * 1000)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+
+            for fd, event in ready:
+                for watch in watches:
+                    if watch.fileno() == fd:
+                        watch.drain()
+                        if watch.once:
+                            # Stays readable forever, so stop listening to it
+                            poller.unregister(fd)
+    finally:
+        for watch in watches:
+            watch.close()
@@ -0,0 +1,223 @@
+# Copyright 2010 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Capturing the output of services we daemonize into log files, and following them.
+
+A service's stdout and stderr go down a pipe to a pump process, which buffers what it
+reads and writes it out in large chunks, rotating the file by size. The service never
+waits on the disk, only on the pipe.
+
+The pump is the only thing reading the service's output, so it must outlive any
+trouble with the log. If the log is moved or removed it starts a new one, and if it
+can't write at all, say because the disk is full, it throws the output away rather
+than exiting and leaving the service to die of a broken pipe. """
+
+import os, sys, errno, select, time
+
+from isotoma.recipe.cluster.events import wait_for
+
+
+class LogFile(object):
+
+    """ I am a log file that is rotated when it grows past max_bytes, keeping backups old copies """
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=5, buffer_size=64 * 1024, flush_interval=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.fd = None
+        self.dropped = 0
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self.size = os.fstat(self.fd).st_size
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def moved(self):
+        """ I check whether the file at path is still the one I have open """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return True
+        opened = os.fstat(self.fd)
+        return (st.st_dev, st.st_ino) != (opened.st_dev, opened.st_ino)
+
+    def rotate(self):
+        """ I move the log to .1, .1 to .2 and so on, dropping the oldest, and start a new one """
+        self.close()
+        try:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists("%s.%d" % (self.path, i)):
+                    os.rename("%s.%d" % (self.path, i), "%s.%d" % (self.path, i + 1))
+            if self.backups:
+                os.rename(self.path, "%s.1" % self.path)
+            else:
+                os.unlink(self.path)
+        except EnvironmentError:
+            # Someone else moved the logs around, start a new one anyway
+            pass
+        self.open()
+
+    def write(self, data):
+        """ I append data to the log, starting a new one if it has grown too big or been moved.
+
+        If it can't be written the data is dropped, and the log is opened again next time """
+        try:
+            if self.fd is not None and self.moved():
+                self.close()
+            if self.fd is None:
+                self.open()
+            pending = data
+            if self.dropped:
+                pending = "[%d bytes of output were lost]\n%s" % (self.dropped, data)
+            if self.max_bytes and self.size and self.size + len(pending) > self.max_bytes:
+                self.rotate()
+            while pending:
+                written = os.write(self.fd, pending)
+                self.size += written
+                pending = pending[written:]
+            self.dropped = 0
+        except EnvironmentError:
+            self.close()
+            self.dropped += len(data)
+
+    def pump(self, fd):
+        """ I copy everything read from fd into the log until it is closed.
+
+        What is read is held until there is buffer_size of it, or it is flush_interval
+        seconds old, so a chatty service costs a write every so often rather than one per line """
+        if self.fd is None:
+            try:
+                self.open()
+            except EnvironmentError:
+                # write will try again
+                pass
+
+        buffered = []
+        size = 0
+        oldest = None
+
+        while True:
+            timeout = None
+            if buffered:
+                timeout = max(0, oldest + self.flush_interval - time.time())
+            try:
+                readable = select.select([fd], [], [], timeout)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+
+            data = None
+            if readable:
+                try:
+                    data = os.read(fd, self.buffer_size)
+                except OSError, e:
+                    if e.errno != errno.EINTR:
+                        raise
+                    continue
+                if data:
+                    if not buffered:
+                        oldest = time.time()
+                    buffered.append(data)
+                    size += len(data)
+
+            if buffered and (not data or size >= self.buffer_size or time.time() - oldest >= self.flush_interval):
+                self.write("".join(buffered))
+                buffered = []
+                size = 0
+
+            if readable and not data:
+                # Everything writing to us has exited
+                break
+
+        self.close()
+
+
+def get_log(path, settings):
+    """ I return the LogFile for a service's output, sized by its settings """
+    return LogFile(path,
+        max_bytes=int(settings.get("log-max-bytes", 10 * 1024 * 1024)),
+        backups=int(settings.get("log-backups", 5)))
+
+
+def tail(path, lines=10):
+    """ I return the last lines of a file """
+    fp = open(path)
+    try:
+        fp.seek(0, 2)
+        end = fp.tell()
+        data = ""
+        # Read backwards until we have enough lines
+        while end > 0 and data.count("\n") <= lines:
+            start = max(0, end - 8192)
+            fp.seek(start)
+            data = fp.read(end - start) + data
+            end = start
+    finally:
+        fp.close()
+    if lines <= 0 or not data:
+        return ""
+    trailing = data.endswith("\n")
+    if trailing:
+        data = data[:-1]
+    return "\n".join(data.split("\n")[-lines:]) + ("\n" if trailing else "")
+
+
+def follow(path, lines=10, forever=False, out=None):
+    """ I print the last lines of a log, and with forever everything written to it after that.
+
+    Rather than sleeping between reads I wait for inotify to tell me the log's directory
+    has changed. When the log is rotated I finish the old file then carry on with the new one """
+    out = out or sys.stdout
+    out.write(tail(path, lines))
+    out.flush()
+    if not forever:
+        return
+
+    fp = open(path)
+    fp.seek(0, 2)
+
+    def changed():
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return st.st_ino != os.fstat(fp.fileno()).st_ino or st.st_size != fp.tell()
+
+    while True:
+        wait_for(changed, 3600, directory=os.path.dirname(path) or ".", max_interval=60)
+
+        data = fp.read()
+        if data:
+            out.write(data)
+            out.flush()
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if st.st_ino != os.fstat(fp.fileno()).st_ino:
+            # Rotated, whatever was left in the old file has been read
+            fp.close()
+            fp = open(path)
+        elif st.st_size < fp.tell():
+            # Truncated
+            fp.seek(0)
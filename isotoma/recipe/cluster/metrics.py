@@ -0,0 +1,198 @@
+# Copyright 2010 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Exposing the state of a cluster's services as OpenMetrics, for Prometheus to scrape.
+
+The state comes from a snapshot of the services, which reads /proc once for the whole
+cluster. Snapshots are kept for a while and the timings history is only read again when
+it has changed, so scraping often costs little more than formatting the text. """
+
+import os, time
+
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Upper bounds, in seconds, of the start and stop latency histogram buckets
+BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(int(value))
+
+
+def histogram(values, buckets=BUCKETS):
+    """ I return the cumulative count of values in each bucket, with the count and sum of them all """
+    counts = []
+    for bound in buckets:
+        counts.append((bound, len([value for value in values if value <= bound])))
+    counts.append((float("inf"), len(values)))
+    return {"buckets": counts, "count": len(values), "sum": sum(values)}
+
+
+class Collector(object):
+
+    """ I gather the metrics of a collection of services and render them as OpenMetrics.
+
+    The services are looked at no more than once every interval seconds. restarts is a
+    dict of service name to how many times it has been restarted, if that is known """
+
+    def __init__(self, services, history=None, interval=5.0, restarts=None, clock=time.time):
+        self.services = services
+        self.history = history
+        self.interval = interval
+        self.restarts = restarts
+        self.clock = clock
+
+        self.snapshot = None
+        self.collected = None
+        self.history_source = None
+        self.latencies = {}
+
+    def refresh(self):
+        """ I take a new snapshot of the services if the last one is older than interval """
+        now = self.clock()
+        if self.collected is not None and now - self.collected < self.interval:
+            return
+        self.snapshot = self.services.snapshot()
+        self.collected = now
+        self.refresh_latencies()
+
+    def refresh_latencies(self):
+        """ I build the latency histograms again, if the timings history has changed since they were built """
+        if not self.history:
+            return
+        try:
+            st = os.stat(self.history.path)
+            source = (st.st_size, st.st_mtime)
+        except OSError:
+            source = None
+        if source == self.history_source:
+            return
+
+        totals = {}
+        for timing in self.history.read():
+            if timing.get("ok") and timing.get("action") in ("start", "stop"):
+                totals.setdefault((timing["service"], timing["action"]), []).append(timing["total"])
+        self.latencies = dict((key, histogram(values)) for key, values in totals.items())
+        self.history_source = source
+
+    def samples(self):
+        """ I return each metric as its name, type, help and a list of label dicts and values """
+        self.refresh()
+
+        cluster = self.services.cluster or ""
+        labels = lambda name: {"cluster": cluster, "service": name}
+
+        up, pid, start_time, rss, cpu, restarts = [], [], [], [], [], []
+        for state in self.snapshot:
+            up.append((labels(state["name"]), 1 if state["alive"] else 0))
+            if self.restarts is not None:
+                restarts.append((labels(state["name"]), self.restarts.get(state["name"], 0)))
+            if not state["alive"]:
+                continue
+            pid.append((labels(state["name"]), state["pid"]))
+            if "start_time" in state:
+                start_time.append((labels(state["name"]), float(state["start_time"])))
+                rss.append((labels(state["name"]), state["rss"]))
+                cpu.append((labels(state["name"]), float(state["cpu_time"])))
+
+        metrics = [
+            ("cluster_service_up", "gauge", "Whether the service is running.", up),
+            ("cluster_service_pid", "gauge", "The pid of the running service.", pid),
+            ("cluster_service_start_time_seconds", "gauge", "When the service was started, in seconds since the epoch.", start_time),
+            ("cluster_service_resident_memory_bytes", "gauge", "The resident set size of the service.", rss),
+            ("cluster_service_cpu_seconds", "counter", "The user and system cpu time used by the service.", cpu),
+            ]
+        if self.restarts is not None:
+            metrics.append(("cluster_service_restarts", "counter", "How many times the supervisor has restarted the service.", restarts))
+
+        for action in ("start", "stop"):
+            histograms = []
+            for (name, timed), values in sorted(self.latencies.items()):
+                if timed == action:
+                    histograms.append((labels(name), values))
+            metrics.append(("cluster_service_%s_duration_seconds" % action, "histogram",
+                "How long the service took to %s." % action, histograms))
+        return metrics
+
+    def render(self):
+        """ I return the metrics in the OpenMetrics text format """
+        lines = []
+        for name, kind, description, samples in self.samples():
+            lines.append("# TYPE %s %s" % (name, kind))
+            lines.append("# HELP %s %s" % (name, description))
+            for labels, value in samples:
+                if kind == "histogram":
+                    for bound, count in value["buckets"]:
+                        lines.append(self.sample(name + "_bucket", dict(labels, le=format_value(bound)), count))
+                    lines.append(self.sample(name + "_count", labels, value["count"]))
+                    lines.append(self.sample(name + "_sum", labels, float(value["sum"])))
+                elif kind == "counter":
+                    lines.append(self.sample(name + "_total", labels, value))
+                else:
+                    lines.append(self.sample(name, labels, value))
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def sample(self, name, labels, value):
+        label_text = ",".join('%s="%s"' % (key, escape(labels[key])) for key in sorted(labels))
+        return "%s{%s} %s" % (name, label_text, format_value(value))
+
+
+def parse_address(value):
+    """ I turn host:port, or just a port, into an address to listen on. With no host I listen on every interface """
+    host, sep, port = value.strip().rpartition(":")
+    return host, int(port)
+
+
+def make_server(address, collector):
+    """ I return an HTTP server that serves the collector's metrics at /metrics.
+
+    It doesn't run by itself: its socket is meant to be polled along with everything
+    else, calling handle_request when it is readable """
+    import BaseHTTPServer
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        # Don't let a slow client hold up the loop serving us for long
+        timeout = 5
+
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = collector.render()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    from isotoma.recipe.cluster.ctl import set_cloexec
+    server = BaseHTTPServer.HTTPServer(address, Handler)
+    # Services started while we listen mustn't keep the port once we have gone
+    set_cloexec(server.socket.fileno())
+    server.timeout = 0
+    return server
@@ -0,0 +1,108 @@
+# Copyright 2010 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+
+
+class Probe(object):
+
+    """ I check whether a service is ready to handle requests """
+
+    def __init__(self, target, timeout=1.0):
+        self.target = target
+        self.timeout = timeout
+
+    def __call__(self):
+        try:
+            return self.check()
+        except (socket.error, EnvironmentError):
+            return False
+
+    def check(self):
+        raise NotImplementedError(self.check)
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.target)
+
+
+def parse_address(target):
+    """ I turn host:port into an address to connect to. I raise ValueError if it isn't one """
+    host, sep, port = target.strip().rpartition(":")
+    if not sep or not host:
+        raise ValueError("'%s' is not host:port" % target.strip())
+    try:
+        return host.strip("[]"), int(port)
+    except ValueError:
+        raise ValueError("'%s' is not host:port" % target.strip())
+
+
+class TcpProbe(Probe):
+
+    """ I am ready when something accepts connections on host:port """
+
+    def check(self):
+        s = socket.create_connection(parse_address(self.target), self.timeout)
+        s.close()
+        return True
+
+
+class HttpProbe(Probe):
+
+    """ I am ready when a url can be fetched without an error status """
+
+    def check(self):
+        import urllib2
+        try:
+            response = urllib2.urlopen(self.target.strip(), timeout=self.timeout)
+        except urllib2.HTTPError, e:
+            e.close()
+            return False
+        response.close()
+        return True
+
+
+class SocketProbe(Probe):
+
+    """ I am ready when something accepts connections on a unix socket """
+
+    def check(self):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.settimeout(self.timeout)
+            s.connect(self.target.strip())
+        finally:
+            s.close()
+        return True
+
+
+PROBES = (
+    ("ready-tcp", TcpProbe),
+    ("ready-http", HttpProbe),
+    ("ready-socket", SocketProbe),
+    )
+
+
+def get_probes(settings):
+    """ I return the probes configured by a service's settings """
+    from isotoma.recipe.cluster.ctl import ActionFailed
+    probes = []
+    for key, factory in PROBES:
+        if settings.get(key, "").strip():
+            if factory is TcpProbe:
+                try:
+                    parse_address(settings[key])
+                except ValueError, e:
+                    raise ActionFailed("%s %s" % (key, e.args[0]))
+            probes.append(factory(settings[key]))
+    return probes
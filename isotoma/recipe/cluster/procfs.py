@@ -0,0 +1,187 @@
+# Copyright 2010 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Reading process information straight out of /proc rather than shelling out to ps """
+
+import os, time
+
+
+PROC = "/proc"
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+_boot_time = None
+
+def boot_time():
+    """ I return when the machine booted, in seconds since the epoch """
+    global _boot_time
+    if _boot_time is None:
+        for line in open(os.path.join(PROC, "stat")):
+            if line.startswith("btime "):
+                _boot_time = int(line.split()[1])
+                break
+    return _boot_time
+
+
+def available():
+    return os.path.exists(os.path.join(PROC, "self", "stat"))
+
+
+def running_pids():
+    """ I return the set of every pid on the machine, from a single listing of /proc """
+    return set(int(name) for name in os.listdir(PROC) if name.isdigit())
+
+
+def process_stat(pid):
+    """ I return the interesting fields of /proc/<pid>/stat, or None if there is no such process.
+
+    Times are in clock ticks and rss is in pages """
+    try:
+        data = open(os.path.join(PROC, str(pid), "stat")).read()
+    except IOError:
+        return None
+
+    # The command name is in brackets and can contain spaces, so split after it
+    fields = data[data.rindex(")") + 2:].split()
+    return {
+        "state": fields[0],
+        "utime": int(fields[11]),
+        "stime": int(fields[12]),
+        "starttime": int(fields[19]),
+        "rss": int(fields[21]),
+        }
+
+
+def process_info(pid, now=None):
+    """ I return the start time, uptime and cpu time in seconds and the rss in bytes of a process """
+    stat = process_stat(pid)
+    if stat is None:
+        return None
+
+    if now is None:
+        now = time.time()
+
+    started = boot_time() + float(stat["starttime"]) / CLK_TCK
+    return {
+        "start_time": round(started, 2),
+        "uptime": round(max(0.0, now - started), 2),
+        "cpu_time": float(stat["utime"] + stat["stime"]) / CLK_TCK,
+        "rss": stat["rss"] * PAGE_SIZE,
+        }
+
+
+def read_cmdline(pid):
+    """ I return the command line of a process as a list, or None if there is no such process """
+    try:
+        data = open(os.path.join(PROC, str(pid), "cmdline")).read()
+    except IOError:
+        return None
+    return data.rstrip("\0").split("\0")
+
+
+def cpus_allowed(pid):
+    """ I return the cpus a process may run on, as a cpu list like 0-3,8, or None if there is no such process """
+    try:
+        lines = open(os.path.join(PROC, str(pid), "status")).readlines()
+    except IOError:
+        return None
+    for line in lines:
+        if line.startswith("Cpus_allowed_list:"):
+            return line.split(":", 1)[1].strip()
+    return None
+
+
+def read_sockets(pid):
+    """ I return the inodes of the sockets a process has open. Processes we can't look inside have none """
+    fddir = os.path.join(PROC, str(pid), "fd")
+    inodes = set()
+    try:
+        fds = os.listdir(fddir)
+    except OSError:
+        return inodes
+    for fd in fds:
+        try:
+            target = os.readlink(os.path.join(fddir, fd))
+        except OSError:
+            continue
+        if target.startswith("socket:["):
+            inodes.add(int(target[8:-1]))
+    return inodes
+
+
+def listening_ports():
+    """ I return a dict mapping the inode of every listening TCP socket to its port """
+    ports = {}
+    for name in ("tcp", "tcp6"):
+        try:
+            lines = open(os.path.join(PROC, "net", name)).readlines()[1:]
+        except IOError:
+            continue
+        for line in lines:
+            fields = line.split()
+            # 0A is TCP_LISTEN
+            if fields[3] != "0A":
+                continue
+            ports[int(fields[9])] = int(fields[1].rsplit(":", 1)[1], 16)
+    return ports
+
+
+def scan(sockets=False):
+    """ I read every process on the machine in a single pass over /proc.
+
+    I return a list of dicts holding each process's pid, command line and start time,
+    and the inodes of its sockets if sockets is true """
+    processes = []
+    for pid in running_pids():
+        cmdline = read_cmdline(pid)
+        stat = process_stat(pid)
+        if cmdline is None or stat is None:
+            # It went away while we were looking
+            continue
+        process = {"pid": pid, "cmdline": cmdline, "starttime": stat["starttime"]}
+        if sockets:
+            process["sockets"] = read_sockets(pid)
+        processes.append(process)
+    return processes
+
+
+class ProcessCache(object):
+
+    """ I remember the parts of a process that can't change while it runs, so they are only read once per run.
+
+    The start time is read each time because it tells us whether a pid still belongs to
+    the same process. The command line hash is cached against the pid and start time """
+
+    def __init__(self):
+        self.hashes = {}
+
+    def fingerprint(self, pid):
+        """ I return (pid, start time, command line hash) for a process, or None if there is no such process """
+        stat = process_stat(pid)
+        if stat is None:
+            return None
+
+        key = (pid, stat["starttime"])
+        if key not in self.hashes:
+            cmdline = read_cmdline(pid)
+            if cmdline is None:
+                return None
+            import hashlib
+            self.hashes[key] = hashlib.sha1("\0".join(cmdline)).hexdigest()[:16]
+        return key + (self.hashes[key], )
+
+
+cache = ProcessCache()
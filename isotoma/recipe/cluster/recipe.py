@@ -12,9 +12,46 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import logging, os, sys, ConfigParser
+import logging, os, sys, ConfigParser, StringIO, hashlib
+import pkg_resources
 from zc.buildout import UserError, easy_install
 
+from isotoma.recipe.cluster.ctl import dependency_waves, asbool, settings_fingerprint, write_manifest, read_manifest, manifest_hash, manifest_path
+
+
+FAST_LAUNCHER = """#!%(python)s -S
+%(preamble)s
+# Generated by isotoma.recipe.cluster. This launcher skips site.py and
+# pkg_resources so that commands called often, like status, start quickly.
+
+import sys, imp
+
+# Stand in for the namespace packages rather than letting pkg_resources set them up
+for name in ("isotoma", "isotoma.recipe"):
+    module = imp.new_module(name)
+    module.__path__ = [%(location)r + "/" + name.replace(".", "/")]
+    sys.modules[name] = module
+
+sys.path[0:0] = [%(location)r]
+
+from isotoma.recipe.cluster import ctl
+
+if __name__ == '__main__':
+    sys.exit(ctl.main(%(config)r))
+"""
+
+def write_if_changed(path, data):
+    """ I write data to path, unless that is what it already holds. I return True if I wrote it """
+    if os.path.exists(path) and open(path, "rb").read() == data:
+        return False
+    fp = open(path, "wb")
+    try:
+        fp.write(data)
+    finally:
+        fp.close()
+    return True
+
+
 class Cluster(object):
 
     def __init__(self, buildout, name, options):
@@ -27,14 +64,9 @@ class Cluster(object):
         else:
             options.setdefault("varrun-directory", os.path.join(self.buildout['buildout']['directory'], "var", "run"))
 
-    def install(self):
-        pybin = self.buildout["buildout"]["executable"]
+    def build_config(self):
+        """ I return the cluster.cfg for this part, with every service's settings resolved """
         bindir = self.buildout['buildout']['bin-directory']
-        partsdir = os.path.join(self.buildout['buildout']['parts-directory'], self.name)
-        cfg = os.path.join(partsdir, "cluster.cfg")
-
-        if not os.path.exists(partsdir):
-            os.makedirs(partsdir)
 
         services = []
         for s in self.options["services"].strip().split():
@@ -42,6 +74,19 @@ class Cluster(object):
             if s:
                 services.append(s)
 
+        names = dict((s, self.buildout[s].get("name", s)) for s in services)
+        depends = {}
+        for s in services:
+            deps = []
+            for dep in self.buildout[s].get("depends-on", "").split():
+                deps.append(names.get(dep, dep))
+            depends[names[s]] = deps
+
+        try:
+            dependency_waves([names[s] for s in services], depends)
+        except ValueError, e:
+            raise UserError(e.args[0])
+
         config = ConfigParser.RawConfigParser()
 
         config.add_section('cluster')
@@ -51,6 +96,15 @@ class Cluster(object):
         config.set('cluster', 'varrundir', self.options["varrun-directory"])
         config.set('cluster', 'user', self.options.get("force-user", "root"))
         config.set('cluster', 'owner', self.options.get("owner", "root"))
+        config.set('cluster', 'parallel', self.options.get("parallel", "false"))
+        config.set('cluster', 'max-parallel', self.options.get("max-parallel", "32"))
+        config.set('cluster', 'rolling-batch-size', self.options.get("rolling-batch-size", "1"))
+        config.set('cluster', 'adopt', self.options.get("adopt", "false"))
+        config.set('cluster', 'auto-pin', self.options.get("auto-pin", "false"))
+        config.set('cluster', 'metrics-listen', self.options.get("metrics-listen", ""))
+        config.set('cluster', 'metrics-interval', self.options.get("metrics-interval", "5"))
+        config.set('cluster', 'ssh', self.options.get("ssh", "ssh"))
+        config.set('cluster', 'remote-script', self.options.get("remote-script", os.path.join(bindir, self.name)))
 
         for s in services:
             config.add_section(s)
@@ -60,16 +114,92 @@ class Cluster(object):
             for key, value in part.items():
                 config.set(s, key, value)
 
-        config.write(open(cfg, 'wb'))
+            if depends[names[s]]:
+                config.set(s, "depends-on", " ".join(depends[names[s]]))
+
+            # Cluster wide defaults for settings each service can override
+            for key in ("cgroup-root", "log-dir", "hosts"):
+                if key in self.options and not config.has_option(s, key):
+                    config.set(s, key, self.options[key])
+
+            # Everything in the part goes into the fingerprint, even settings the cluster
+            # script never reads, like a zope instance's cache size
+            config.set(s, "settings-fingerprint", settings_fingerprint(dict(config.items(s))))
+
+        return config
+
+    def render(self):
+        """ I return the cluster.cfg for this part and its text """
+        config = self.build_config()
+        fp = StringIO.StringIO()
+        config.write(fp)
+        return config, fp.getvalue()
+
+    def install(self):
+        pybin = self.buildout["buildout"]["executable"]
+        bindir = self.buildout['buildout']['bin-directory']
+        partsdir = os.path.join(self.buildout['buildout']['parts-directory'], self.name)
+        cfg = os.path.join(partsdir, "cluster.cfg")
+
+        if not os.path.exists(partsdir):
+            os.makedirs(partsdir)
+
+        config, text = self.render()
+
+        # Files that haven't changed are left alone, so their mtimes only move when they do
+        write_if_changed(cfg, text)
+        write_manifest(cfg, config)
 
         ws = easy_install.working_set(
             ["isotoma.recipe.cluster"], pybin,
             [self.buildout["buildout"]['develop-eggs-directory'], self.buildout['buildout']['eggs-directory']])
 
-        scripts = easy_install.scripts(
-            [(self.name, "isotoma.recipe.cluster.ctl", "main")],
-            ws, pybin, bindir, arguments='"%s"' % cfg,
-            initialization=self.options.get("preamble", ""))
-
-        return [os.path.join(bindir, self.name), cfg]
+        if asbool(self.options.get("fast-launcher", "false")):
+            self.write_fast_launcher(ws, pybin, bindir, cfg)
+        else:
+            # easy_install only rewrites scripts whose contents have changed
+            scripts = easy_install.scripts(
+                [(self.name, "isotoma.recipe.cluster.ctl", "main")],
+                ws, pybin, bindir, arguments='"%s"' % cfg,
+                initialization=self.options.get("preamble", ""))
+
+        return self.installed_paths()
+
+    def installed_paths(self):
+        cfg = os.path.join(self.buildout['buildout']['parts-directory'], self.name, "cluster.cfg")
+        return [os.path.join(self.buildout['buildout']['bin-directory'], self.name), cfg, manifest_path(cfg)]
+
+    def update(self):
+        """ I am called instead of install when this part's options haven't changed.
+
+        The services' settings live in other parts, so buildout can't tell whether they have
+        changed. I compare a hash of them with the one in the manifest, and only install
+        again, rewriting whatever is different, if it has changed or a file has gone missing """
+        paths = self.installed_paths()
+        cfg = paths[1]
+
+        text = self.render()[1]
+        if read_manifest(cfg) is None or manifest_hash(cfg) != hashlib.sha1(text).hexdigest():
+            return self.install()
+        for path in paths:
+            if not os.path.exists(path):
+                return self.install()
+        return paths
+
+    def write_fast_launcher(self, ws, pybin, bindir, cfg):
+        """ I write a control script that only puts this egg on the path, instead of the whole working set """
+        dist = ws.find(pkg_resources.Requirement.parse("isotoma.recipe.cluster"))
+        path = os.path.join(bindir, self.name)
+
+        changed = write_if_changed(path, FAST_LAUNCHER % {
+            "python": pybin,
+            "preamble": self.options.get("preamble", "").strip(),
+            "location": dist.location,
+            "config": cfg,
+            })
+        os.chmod(path, 0755)
+
+        if changed:
+            # Say the same thing easy_install does about the scripts it writes
+            logging.getLogger("zc.buildout.easy_install").info("Generated script %r.", path)
 
@@ -0,0 +1,298 @@
+# Copyright 2010 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Controlling services on other hosts by running the cluster script there over ssh.
+
+Each host gets one ssh connection for the whole run. The first command sent to a host
+opens a master connection, and every later command to it is multiplexed over that
+rather than connecting and authenticating again. The masters are closed when we are done. """
+
+import os, shlex, tempfile, shutil
+
+from isotoma.recipe.cluster.ctl import run_concurrently
+from isotoma.recipe.cluster.timings import json_module
+
+
+# The actions that are sent to other hosts
+ACTIONS = ("start", "stop", "restart", "rolling-restart", "apply", "status", "running")
+
+
+def split_hosts(services):
+    """ I split service settings into the ones run here and a dict of host to the names of services run there.
+
+    A service runs on every host in its hosts setting, or here if it has none """
+    local = []
+    remote = {}
+    for service in services:
+        hosts = service.get("hosts", "").split()
+        if not hosts:
+            local.append(service)
+        for host in hosts:
+            remote.setdefault(host, []).append(service["name"])
+    return local, remote
+
+
+def host_waves(services):
+    """ I return the dependency waves of service settings as lists of names, if any service
+    depends on one that runs somewhere else, and None if none do.
+
+    A service runs on the hosts in its hosts setting, or here if it has none. Each
+    wave has to be acted on everywhere before the next one is started """
+    from isotoma.recipe.cluster.ctl import dependency_waves, ActionFailed
+
+    places = dict((service["name"], frozenset(service.get("hosts", "").split())) for service in services)
+    depends = {}
+    crossing = False
+    for service in services:
+        name = service["name"]
+        depends[name] = [dep for dep in service.get("depends-on", "").split() if dep in places]
+        if [dep for dep in depends[name] if places[dep] != places[name]]:
+            crossing = True
+    if not crossing:
+        return None
+
+    try:
+        return dependency_waves([service["name"] for service in services], depends)
+    except ValueError, e:
+        raise ActionFailed(e.args[0])
+
+
+class SshPool(object):
+
+    """ I run commands on other hosts, over one multiplexed ssh connection per host """
+
+    def __init__(self, ssh="ssh"):
+        import threading
+        self.ssh = shlex.split(ssh)
+        self.control_dir = None
+        # Host to the control directory its master was opened under
+        self.hosts = {}
+        # Commands are run from a thread per host, and must all share one control directory
+        self.lock = threading.Lock()
+
+    def options(self, control_dir):
+        # %C is a hash of the connection, which keeps the socket path short enough
+        return [
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath=%s" % os.path.join(control_dir, "%C"),
+            "-o", "ControlPersist=yes",
+            "-o", "BatchMode=yes",
+            ]
+
+    def run(self, host, argv):
+        """ I run argv on host and return its exit status and output """
+        import subprocess, pipes
+        self.lock.acquire()
+        try:
+            if self.control_dir is None:
+                self.control_dir = tempfile.mkdtemp(prefix="cluster-ssh-")
+            control_dir = self.hosts.setdefault(host, self.control_dir)
+        finally:
+            self.lock.release()
+        command = " ".join(pipes.quote(arg) for arg in argv)
+        p = subprocess.Popen(self.ssh + self.options(control_dir) + [host, command],
+            stdin=open(os.devnull), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = p.communicate()[0]
+        return p.returncode, output
+
+    def close(self):
+        """ I close the master connection to every host we have used """
+        import subprocess
+        devnull = open(os.devnull, "w")
+        self.lock.acquire()
+        try:
+            for host, control_dir in self.hosts.items():
+                subprocess.call(self.ssh + self.options(control_dir) + ["-O", "exit", host], stdout=devnull, stderr=devnull)
+            for control_dir in set(self.hosts.values() + [self.control_dir]):
+                if control_dir:
+                    shutil.rmtree(control_dir, True)
+            self.hosts.clear()
+            self.control_dir = None
+        finally:
+            self.lock.release()
+
+
+class RemoteHosts(object):
+
+    """ I send cluster commands to the cluster script on other hosts, all hosts at once """
+
+    actions = ACTIONS
+
+    def __init__(self, pool, script, hosts):
+        self.pool = pool
+        self.script = script
+        self.hosts = hosts
+
+    def subset(self, names):
+        """ I return the hosts running any of the services called names, acting only on those """
+        hosts = {}
+        for host, services in self.hosts.items():
+            services = [name for name in services if name in names]
+            if services:
+                hosts[host] = services
+        return RemoteHosts(self.pool, self.script, hosts)
+
+    def command(self, host, action, options=()):
+        """ I return the command line to run action on the services on host, and only those """
+        argv = [self.script, "--local"]
+        for name in self.hosts[host]:
+            argv.extend(["--service", name])
+        argv.extend(options)
+        argv.append(action)
+        return argv
+
+    def run(self, action, options=()):
+        """ I run action on every host at once and return a dict of host to exit status and output """
+        results = {}
+
+        def run(host):
+            results[host] = self.pool.run(host, self.command(host, action, options))
+
+        for host, e in run_concurrently(run, sorted(self.hosts)):
+            results[host] = (255, "%s\n" % e)
+        return results
+
+    def run_each(self, action, options=()):
+        """ I run action on one host after another, stopping at the first that fails """
+        results = {}
+        for host in sorted(self.hosts):
+            results[host] = self.pool.run(host, self.command(host, action, options))
+            if results[host][0] != 0:
+                break
+        return results
+
+    def snapshot(self):
+        """ I return the state of every service on every host, as the local snapshot does with a host added """
+        json = json_module()
+        snapshot = []
+        for host, (status, output) in sorted(self.run("status", ["--json"]).items()):
+            try:
+                states = json.loads(output)["services"]
+            except (ValueError, KeyError, TypeError):
+                # The host couldn't be reached or the script failed
+                message = output.strip().splitlines()[-1:] or ["exit status %d" % status]
+                states = [{"name": name, "pid": None, "alive": False, "error": message[0]} for name in self.hosts[host]]
+            for state in states:
+                state["host"] = host
+            snapshot.extend(states)
+        return snapshot
+
+
+def print_results(results):
+    """ I print what each host said, prefixed with the host, and return how many hosts failed """
+    failed = 0
+    for host, (status, output) in sorted(results.items()):
+        for line in output.splitlines():
+            print "%s: %s" % (host, line)
+        if status != 0:
+            print "%s: failed with exit status %d" % (host, status)
+            failed += 1
+    return failed
+
+
+def format_status(snapshot):
+    """ I return the state of services across hosts as a table """
+    rows = [("HOST", "SERVICE", "STATE", "PID")]
+    for state in snapshot:
+        if state["alive"]:
+            condition = "running"
+        elif state.get("error"):
+            condition = "unknown: %s" % state["error"]
+        else:
+            condition = "stopped"
+        rows.append((state.get("host", "local"), state["name"], condition, str(state["pid"] or "-")))
+
+    widths = [max(len(row[i]) for row in rows) for i in range(3)]
+    lines = []
+    for row in rows:
+        lines.append("  ".join(cell.ljust(width) for cell, width in zip(row, widths)) + "  " + row[3])
+    return "\n".join(lines)
+
+
+def control(action, services, remote, as_json=False, batch_size=1, client=None, waves=None):
+    """ I run action on services here and on the services on every other host, and return the exit status.
+
+    The other hosts are all sent the action at once while it runs here, except for a
+    rolling restart, which goes through the hosts one at a time after this one so most
+    of the cluster is always serving. If client is a running supervisor, it acts on the
+    services here.
+
+    waves, from host_waves, are needed when services depend on services on other hosts.
+    Services are then started, stopped and applied a wave at a time across every host,
+    with dependencies started first and dependents stopped first """
+    from isotoma.recipe.cluster.ctl import NothingToDo, ActionFailed, supervised
+
+    try:
+        if action in ("status", "running"):
+            snapshot = services.snapshot() + remote.snapshot()
+            not_running = len([state for state in snapshot if not state["alive"]])
+            if as_json:
+                print json_module().dumps({"services": snapshot, "not_running": not_running}, sort_keys=True, indent=2)
+            elif action == "status":
+                print format_status(snapshot)
+            return not_running
+
+        def run_local(action, services):
+            """ I run action on services here, returning True if it failed """
+            if not services.services:
+                return False
+            try:
+                if client:
+                    supervised(client, action, services=[service.service for service in services.services], batch_size=batch_size)
+                elif action == "rolling-restart":
+                    services.rolling_restart(batch_size)
+                else:
+                    getattr(services, action)()
+            except NothingToDo, e:
+                print "Nothing To Do:", e.args[0]
+            except ActionFailed, e:
+                print "Action Failed:", e.args[0]
+                return True
+            return False
+
+        def run_everywhere(action, services, remote):
+            """ I run action here and on every host at once, returning True if it failed anywhere """
+            import threading
+            results = {}
+            t = threading.Thread(target=lambda: results.update(remote.run(action)))
+            t.start()
+            failed = run_local(action, services)
+            t.join()
+            return bool(print_results(results)) or failed
+
+        if action == "rolling-restart":
+            if run_local(action, services):
+                return 1
+            return int(bool(print_results(remote.run_each(action, ["--batch-size", str(batch_size)]))))
+
+        if not waves:
+            return int(run_everywhere(action, services, remote))
+
+        steps = []
+        if action in ("stop", "restart"):
+            steps.extend(("stop", wave) for wave in reversed(waves))
+        if action in ("start", "restart"):
+            steps.extend(("start", wave) for wave in waves)
+        if action == "apply":
+            steps.extend(("apply", wave) for wave in waves)
+
+        failed = False
+        for step, wave in steps:
+            # Keep on stopping after a failure, but don't start anything that depends on it
+            if failed and step != "stop":
+                break
+            failed = run_everywhere(step, services.select(wave), remote.subset(wave)) or failed
+        return int(failed)
+    finally:
+        remote.pool.close()
@@ -0,0 +1,455 @@
+# Copyright 2010 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" A resident process that keeps a cluster's services running.
+
+The supervisor watches each service's pid with a pidfd so it hears about an exit
+straight away, and restarts services that die. It answers requests from the
+cluster script on a unix socket in the run directory, one JSON request and one
+JSON response per connection, and can serve the cluster's metrics over HTTP. """
+
+import os, sys, errno, select, socket, time, random, traceback
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from isotoma.recipe.cluster.ctl import NothingToDo, ActionFailed, set_cloexec
+from isotoma.recipe.cluster.events import ProcessWatch
+from isotoma.recipe.cluster.metrics import Collector, make_server
+
+
+def report(message):
+    """ I print message and the exception being handled, which would otherwise have ended the supervisor """
+    print >>sys.stderr, message
+    traceback.print_exc()
+
+
+class RestartPolicy(object):
+
+    """ I decide how long to wait before restarting a service that died, and when it has died too often to bother.
+
+    The delay doubles with every restart inside the window, with jitter so a cluster
+    of crashing services doesn't restart in lock step. More than max_restarts restarts
+    inside the window and the service is marked failed """
+
+    def __init__(self, backoff=1.0, max_restarts=5, window=60.0, max_delay=60.0, random=random.random):
+        self.backoff = backoff
+        self.max_restarts = max_restarts
+        self.window = window
+        self.max_delay = max_delay
+        self.random = random
+        self.history = []
+        self.failed = False
+
+    @classmethod
+    def from_settings(cls, settings, **kwargs):
+        return cls(
+            backoff=float(settings.get("restart-backoff", 1.0)),
+            max_restarts=int(settings.get("max-restarts", 5)),
+            window=float(settings.get("restart-window", 60.0)),
+            **kwargs)
+
+    def crashed(self, now=None):
+        """ I record a crash and return how long to wait before restarting, or None if the service has failed """
+        if now is None:
+            now = time.time()
+
+        self.history = [t for t in self.history if now - t < self.window]
+        if len(self.history) >= self.max_restarts:
+            self.failed = True
+            return None
+
+        delay = min(self.backoff * 2 ** len(self.history), self.max_delay)
+        self.history.append(now)
+        return delay * (0.5 + self.random() / 2)
+
+    def reset(self):
+        self.history = []
+        self.failed = False
+
+
+class Supervisor(object):
+
+    """ I start a cluster's services, restart them when they die and serve commands on a unix socket """
+
+    # How often to check on services that couldn't be given a pidfd
+    check_interval = 1.0
+
+    def __init__(self, services, socket_path, max_restart_delay=60.0, history=None, metrics_address=None, metrics_interval=5.0, reload=None):
+        self.services = services
+        self.socket_path = socket_path
+        self.max_restart_delay = max_restart_delay
+        self.history = history
+        self.reload = reload
+        self.metrics_address = metrics_address
+        self.metrics_interval = metrics_interval
+
+        self.wanted = set()
+        self.watches = {}
+        self.pending = {}
+        self.restarts = dict((service.service, 0) for service in services.services)
+        self.policies = dict((service.service, RestartPolicy.from_settings(service.settings, max_delay=max_restart_delay))
+            for service in services.services)
+        self.running = False
+        self.listener = None
+        self.metrics_server = None
+        self.collector = Collector(services, history, metrics_interval, restarts=self.restarts)
+
+    def get_service(self, name):
+        for service in self.services.services:
+            if service.service == name:
+                return service
+        raise ActionFailed("No such service '%s'" % name)
+
+    def watch(self, service):
+        """ I get a pidfd for a running service so its exit wakes the main loop """
+        self.unwatch(service)
+        pid = service.pid
+        if not pid:
+            return
+        try:
+            self.watches[service.service] = ProcessWatch(pid)
+        except (OSError, AttributeError):
+            pass
+
+    def unwatch(self, service):
+        watch = self.watches.pop(service.service, None)
+        if watch:
+            watch.close()
+
+    def selection(self, names=None):
+        """ I return the services called names, or all of them if names is None """
+        if names is None:
+            return self.services
+        for name in names:
+            self.get_service(name)
+        return self.services.select(names)
+
+    def start(self, names=None):
+        """ I start every service, or those called names, and keep them running from now on """
+        services = self.selection(names)
+        for service in services.services:
+            self.wanted.add(service.service)
+            self.pending.pop(service.service, None)
+            self.policies[service.service].reset()
+        try:
+            services.start()
+        finally:
+            for service in services.services:
+                self.watch(service)
+
+    def stop(self, names=None):
+        """ I stop every service, or those called names, and stop restarting them """
+        services = self.selection(names)
+        for service in services.services:
+            self.wanted.discard(service.service)
+            self.pending.pop(service.service, None)
+            self.unwatch(service)
+        services.stop()
+
+    def rolling_restart(self, names=None, batch_size=1):
+        """ I restart every service, or those called names, a batch at a time.
+
+        The services are still supervised afterwards, and their exits along the way
+        aren't taken for crashes """
+        services = self.selection(names)
+        for service in services.services:
+            self.unwatch(service)
+            self.wanted.add(service.service)
+            self.pending.pop(service.service, None)
+            self.policies[service.service].reset()
+        try:
+            services.rolling_restart(batch_size)
+        finally:
+            for service in services.services:
+                self.watch(service)
+
+    def apply(self, names=None):
+        """ I read the configuration again and bring the services, or those called names, into line with it.
+
+        Removed services are stopped and forgotten, and services that are added or
+        changed are supervised from now on """
+        if self.reload is None:
+            raise ActionFailed("This supervisor can't read its configuration again")
+        services = self.reload()
+        configured = set(service.service for service in services.services)
+        selected = configured if names is None else set(names)
+        unknown = selected - configured
+        if unknown:
+            raise ActionFailed("No such service '%s'" % ", ".join(sorted(unknown)))
+
+        for service in self.services.services:
+            self.unwatch(service)
+
+        old = dict((service.service, service.settings) for service in self.services.services)
+        self.services = services
+        self.collector.services = services
+        for name in list(self.wanted):
+            if name not in configured:
+                self.wanted.discard(name)
+        for name in list(self.pending):
+            if name not in configured:
+                del self.pending[name]
+
+        for service in services.services:
+            name = service.service
+            self.restarts.setdefault(name, 0)
+            if old.get(name) != service.settings:
+                self.policies[name] = RestartPolicy.from_settings(service.settings, max_delay=self.max_restart_delay)
+            if name in selected:
+                self.wanted.add(name)
+                self.pending.pop(name, None)
+                self.policies[name].reset()
+
+        try:
+            if names is None:
+                services.apply()
+            else:
+                services.select(names).apply()
+        finally:
+            for service in services.services:
+                self.watch(service)
+
+    def check(self):
+        """ I look for wanted services that have died and schedule them to be restarted """
+        now = time.time()
+        for service in self.services.services:
+            name = service.service
+            if name not in self.wanted or name in self.pending:
+                continue
+            if service.alive():
+                continue
+            self.unwatch(service)
+            policy = self.policies[name]
+            delay = policy.crashed(now)
+            if delay is None:
+                print "'%s' exited %d times in %ds, giving up" % (name, policy.max_restarts + 1, policy.window)
+                self.wanted.discard(name)
+                continue
+            print "'%s' exited, restarting in %.1fs" % (name, delay)
+            self.pending[name] = now + delay
+
+    def restart_due(self):
+        """ I restart services whose restart delay has passed """
+        now = time.time()
+        for name, when in self.pending.items():
+            if when > now:
+                continue
+            del self.pending[name]
+            service = self.get_service(name)
+            self.restarts[name] += 1
+            try:
+                service.start()
+            except NothingToDo:
+                pass
+            except ActionFailed, e:
+                print "'%s' failed to restart: %s" % (name, e.args[0])
+            except Exception, e:
+                report("'%s' failed to restart: %s" % (name, e))
+            self.watch(service)
+
+    def status(self, names=None):
+        snapshot = self.selection(names).snapshot()
+        for state in snapshot:
+            name = state["name"]
+            state["restarts"] = self.restarts.get(name, 0)
+            state["supervised"] = name in self.wanted
+            state["failed"] = self.policies[name].failed
+            if name in self.pending:
+                state["restarting_in"] = round(max(0, self.pending[name] - time.time()), 2)
+        not_running = len([state for state in snapshot if not state["alive"]])
+        return {"services": snapshot, "not_running": not_running}
+
+    def handle(self, request):
+        """ I carry out a request from the cluster script and return the response """
+        command = request.get("command")
+        names = request.get("services")
+        try:
+            if command == "status":
+                return self.status(names)
+            elif command == "start":
+                self.start(names)
+            elif command == "stop":
+                self.stop(names)
+            elif command == "restart":
+                self.stop(names)
+                self.start(names)
+            elif command == "rolling-restart":
+                self.rolling_restart(names, request.get("batch_size", 1))
+            elif command == "apply":
+                self.apply(names)
+            elif command == "metrics":
+                if names is None:
+                    return {"metrics": self.collector.render()}
+                collector = Collector(self.selection(names), self.history, restarts=self.restarts)
+                return {"metrics": collector.render()}
+            elif command == "shutdown":
+                self.running = False
+            else:
+                return {"error": "Unknown command '%s'" % command}
+        except NothingToDo, e:
+            return {"nothing_to_do": e.args[0]}
+        except ActionFailed, e:
+            return {"error": e.args[0]}
+        except Exception, e:
+            report("'%s' failed: %s" % (command, e))
+            return {"error": "Unexpected error: %s" % e}
+        return {"ok": True}
+
+    def listen(self):
+        if os.path.exists(self.socket_path):
+            if connect(self.socket_path):
+                raise ActionFailed("A supervisor is already running")
+            os.unlink(self.socket_path)
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        set_cloexec(self.listener.fileno())
+        self.listener.bind(self.socket_path)
+        os.chmod(self.socket_path, 0600)
+        self.listener.listen(16)
+
+        if self.metrics_address:
+            try:
+                self.metrics_server = make_server(self.metrics_address, self.collector)
+            except socket.error, e:
+                self.close()
+                raise ActionFailed("Could not serve metrics on %s:%d: %s" % (self.metrics_address + (e.args[-1],)))
+
+    def accept(self):
+        conn, addr = self.listener.accept()
+        # Requests start services while the connection is open
+        set_cloexec(conn.fileno())
+        try:
+            conn.settimeout(5)
+            data = read_line(conn)
+            # connect() checks we are listening without sending anything
+            if data:
+                response = self.handle(json.loads(data))
+                conn.sendall(json.dumps(response) + "\n")
+        except (socket.error, ValueError), e:
+            print >>sys.stderr, "Bad request from cluster script: %s" % e
+        except Exception, e:
+            report("Could not answer the cluster script: %s" % e)
+        conn.close()
+
+    def serve(self):
+        """ I start the services and then look after them until asked to shut down """
+        self.listen()
+        self.running = True
+        try:
+            try:
+                self.start()
+            except ActionFailed, e:
+                print >>sys.stderr, e.args[0]
+            except Exception, e:
+                report("Could not start the services: %s" % e)
+
+            while self.running:
+                poller = select.poll()
+                poller.register(self.listener.fileno(), select.POLLIN)
+                if self.metrics_server:
+                    poller.register(self.metrics_server.fileno(), select.POLLIN)
+                for watch in self.watches.values():
+                    poller.register(watch.fileno(), select.POLLIN)
+
+                timeout = self.check_interval
+                if self.pending:
+                    timeout = max(0, min(timeout, min(self.pending.values()) - time.time()))
+
+                try:
+                    ready = poller.poll(timeout * 1000)
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    continue
+
+                for fd, event in ready:
+                    if fd == self.listener.fileno():
+                        self.accept()
+                    elif self.metrics_server and fd == self.metrics_server.fileno():
+                        self.metrics_server.handle_request()
+
+                self.check()
+                self.restart_due()
+
+                timings = self.services.collect_timings()
+                if self.history:
+                    try:
+                        self.history.append(timings)
+                    except EnvironmentError, e:
+                        print >>sys.stderr, "Could not record timings: %s" % e
+        finally:
+            self.close()
+
+    def close(self):
+        for service in self.services.services:
+            self.unwatch(service)
+        if self.metrics_server:
+            self.metrics_server.server_close()
+            self.metrics_server = None
+        if self.listener:
+            self.listener.close()
+            self.listener = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+
+def read_line(conn):
+    data = ""
+    while not data.endswith("\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+class Client(object):
+
+    """ I send commands to a running supervisor """
+
+    def __init__(self, socket_path, timeout=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def request(self, command, **kwargs):
+        kwargs["command"] = command
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.settimeout(self.timeout)
+            conn.connect(self.socket_path)
+            conn.sendall(json.dumps(kwargs) + "\n")
+            data = read_line(conn)
+        finally:
+            conn.close()
+        if not data:
+            raise ActionFailed("No response from supervisor")
+        return json.loads(data)
+
+
+def connect(socket_path):
+    """ I return a client for the supervisor listening on socket_path, or None if there isn't one """
+    if not os.path.exists(socket_path):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            conn.connect(socket_path)
+        except socket.error:
+            return None
+    finally:
+        conn.close()
+    return Client(socket_path)
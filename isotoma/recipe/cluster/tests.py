@@ -1,7 +1,8 @@
 """Test setup for isotoma.recipe.apache.
 """
 
-import os, sys, subprocess, re, time
+import os, sys, subprocess, re, time, threading, tempfile, shutil, socket
+import BaseHTTPServer, ConfigParser, StringIO, pwd
 import pkg_resources
 
 import zc.buildout.testing
@@ -10,7 +11,8 @@ import unittest
 import zope.testing
 from zope.testing import doctest, renormalizing
 
-from isotoma.recipe.cluster.ctl import BaseService, Service, Services, NothingToDo
+from isotoma.recipe.cluster.ctl import BaseService, Service, Services, NothingToDo, ActionFailed, dependency_waves
+from isotoma.recipe.cluster import ctl, events, probes, procfs, supervisor, timings, benchmark, affinity, logs, remote, metrics
 
 
 def setUp(test):
@@ -31,6 +33,18 @@ checker = renormalizing.RENormalizing([
 def sibpath(path):
     return os.path.join(os.path.dirname(__file__), path)
 
+def open_files(pid):
+    """ I return what each file descriptor a process has open points at """
+    fddir = "/proc/%d/fd" % pid
+    files = set()
+    for fd in os.listdir(fddir):
+        try:
+            files.add(os.readlink(os.path.join(fddir, fd)))
+        except OSError:
+            pass
+    return files
+
+
 class TestCtl(unittest.TestCase):
 
     def raw_test_service(self, pid, command):
@@ -50,7 +64,8 @@ class TestCtl(unittest.TestCase):
             })
         return s
 
-    def services(self, *pids):
+    def services(self, *pids, **kwargs):
+        extra = kwargs.pop("settings", {})
         services = []
         for pid in pids:
             service = {
@@ -60,9 +75,10 @@ class TestCtl(unittest.TestCase):
                 "stop-command": " ".join((sys.executable, sibpath("testservice.py"), os.path.realpath(pid), "stop")),
                 "env": {"PYTHONPATH": ":".join(sys.path)},
                 }
+            service.update(extra.get(pid, {}))
             services.append(service)
 
-        return Services("", "", services)
+        return Services("", "", services, **kwargs)
 
     def raw_start_service(self, pid):
         self.raw_test_service(pid, "start")
@@ -109,6 +125,253 @@ class TestCtl(unittest.TestCase):
         s.stop()
         self.failUnless(not s.alive())
 
+    def test_service_stop_escalates(self):
+        s = self.service("a.pid")
+        s.settings["start-command"] += " --ignore-term"
+        s.settings["stop-command"] = "true"
+        s.settings["stop-timeout"] = "0.2"
+        s.settings["kill-timeout"] = "0.2"
+        s.start()
+        started = time.time()
+        s.stop()
+        self.failUnless(time.time() - started < 10)
+        self.failUnless(not s.alive())
+        self.failUnless(not os.path.exists(s.pidfile))
+
+    def test_service_stop_drains(self):
+        s = self.service("a.pid")
+        s.settings["drain-signal"] = "USR1"
+        s.settings["stop-command"] = "false"
+        s.start()
+        s.stop()
+        self.failUnless(not s.alive())
+
+    def test_service_timings(self):
+        s = self.services("a.pid")
+        s.start()
+        s.stop()
+        start, stop = s.collect_timings()
+        self.assertEqual((start["action"], start["ok"]), ("start", True))
+        self.assertEqual([phase for phase, duration in start["phases"]], ["exec", "pidfile"])
+        self.assertEqual([phase for phase, duration in stop["phases"]], ["exec", "exit"])
+        self.assertEqual(s.collect_timings(), [])
+
+    def test_benchmark(self):
+        result = benchmark.run(2, "parallel", start_delay=0.1)
+        self.assertEqual(result["services"], 2)
+        for operation in benchmark.OPERATIONS:
+            self.failUnless(result[operation]["ok"], operation)
+        self.failUnless(result["start"]["seconds"] >= 0.1)
+
+    def test_services_adopt_cmdline(self):
+        s = self.services("a.pid", "b.pid", settings={"a.pid": {"adopt-cmdline": re.escape(os.path.realpath("a.pid")) + " start"}})
+        s.start()
+        pid = s.services[0].pid
+        os.unlink(s.services[0].pidfile)
+        self.failUnless(not s.services[0].alive())
+
+        self.assertEqual(s.adopt(), [s.services[0]])
+        self.assertEqual(s.services[0].pid, pid)
+        self.assertEqual(s.adopt(), [])
+        s.stop()
+
+    def test_services_adopt_blank(self):
+        s = self.services("a.pid", settings={"a.pid": {"adopt-cmdline": "", "adopt-port": " "}})
+        self.failIf(s.services[0].adoptable)
+        self.assertEqual(s.adopt(), [])
+        self.assertEqual(s.services[0].find_process(procfs.scan(), {}), None)
+        self.failUnless(not os.path.exists("a.pid"))
+
+    def test_services_adopt_port(self):
+        code = "import socket, time; s = socket.socket(); s.bind(('127.0.0.1', 0)); s.listen(1); print s.getsockname()[1]; time.sleep(30)"
+        p = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE)
+        try:
+            port = p.stdout.readline().strip()
+            s = self.services("a.pid", settings={"a.pid": {"adopt-port": port}})
+            self.assertEqual(s.adopt(), [s.services[0]])
+            self.assertEqual(s.services[0].pid, p.pid)
+        finally:
+            p.kill()
+            p.wait()
+        os.unlink(s.services[0].pidfile)
+
+    def test_service_fingerprint(self):
+        s = self.service("a.pid")
+        s.varrundir = os.path.realpath(".")
+        s.start()
+        pid = s.pid
+        self.assertEqual(s.read_fingerprint()[0], pid)
+        self.failUnless(s.alive())
+
+        # Pretend the pid has since been reused by something else
+        open(s.fingerprint_file, "w").write("%d 1 0123456789abcdef\n" % pid)
+        self.failUnless(not s.alive())
+        self.failUnlessRaises(NothingToDo, s.stop)
+
+        s.write_fingerprint(pid)
+        s.stop()
+        self.failUnless(not os.path.exists(s.fingerprint_file))
+
+    def test_process_cache(self):
+        cache = procfs.ProcessCache()
+        fingerprint = cache.fingerprint(os.getpid())
+        self.assertEqual(fingerprint[0], os.getpid())
+        self.assertEqual(cache.fingerprint(os.getpid()), fingerprint)
+        self.assertEqual(len(cache.hashes), 1)
+
+    def test_service_cgroup(self):
+        root = tempfile.mkdtemp()
+        try:
+            s = self.services("a.pid", settings={"a.pid": {"cgroup-root": root, "memory-max": "1G", "io-weight": "50"}})
+            s.start()
+            group = os.path.join(root, "a.pid")
+            self.assertEqual(open(os.path.join(group, "memory.max")).read(), "1G\n")
+            self.assertEqual(open(os.path.join(group, "io.weight")).read(), "default 50\n")
+            self.assertEqual(open(os.path.join(root, "cgroup.subtree_control")).read(), "+io +memory\n")
+            self.failUnless(open(os.path.join(group, "cgroup.procs")).read().strip().isdigit())
+
+            open(os.path.join(group, "memory.current"), "w").write("1234\n")
+            open(os.path.join(group, "cpu.stat"), "w").write("usage_usec 10\nuser_usec 6\nsystem_usec 4\nnr_periods 0\n")
+            stats = s.snapshot()[0]["cgroup"]
+            self.assertEqual((stats["memory_current"], stats["memory_max"], stats["cpu_usage_usec"]), (1234, "1G", 10))
+            s.stop()
+        finally:
+            shutil.rmtree(root)
+
+    def test_service_cgroup_attach_fails(self):
+        root = tempfile.mkdtemp()
+        try:
+            # Writing our pid into the group will fail
+            os.makedirs(os.path.join(root, "a.pid", "cgroup.procs"))
+            s = self.services("a.pid", settings={"a.pid": {"cgroup-root": root}})
+            self.failUnlessRaises(ActionFailed, s.start)
+            self.failUnless(not self.status_service("a.pid"))
+        finally:
+            shutil.rmtree(root)
+
+    def test_service_cpu_affinity(self):
+        s = self.services("a.pid", settings={"a.pid": {"cpu-affinity": "0"}})
+        s.start()
+        self.assertEqual(s.snapshot()[0]["cpus_allowed"], "0")
+        s.stop()
+
+    def test_service_cpu_affinity_offline(self):
+        for cpus in ("4000", "0,4000-4001", "zero"):
+            s = self.services("a.pid", settings={"a.pid": {"cpu-affinity": cpus}})
+            self.failUnlessRaises(ActionFailed, s.start)
+            self.failUnless(not self.status_service("a.pid"))
+
+    def test_service_daemonized_by_ctl(self):
+        output = os.path.realpath("a.log")
+        s = self.services("a.pid", settings={"a.pid": {
+            "daemonize": "ctl",
+            "foreground-command": " ".join((sys.executable, sibpath("testservice.py"), os.path.realpath("a.pid"), "fg")),
+            "output": output,
+            }})
+        service = s.services[0]
+        del service.settings["stop-command"]
+        held = open(os.path.realpath("held"), "w")
+        try:
+            s.start()
+            self.failUnless(service.alive())
+            self.failUnless("fg" in procfs.read_cmdline(service.pid))
+            self.failIf(held.name in open_files(service.pid))
+            self.failUnless(events.wait_for(lambda: os.path.exists(output) and "foreground" in open(output).read(), 10))
+            s.stop()
+            self.failUnless(not self.status_service("a.pid"))
+            self.failUnless(not os.path.exists("a.pid"))
+        finally:
+            held.close()
+            os.unlink(held.name)
+            os.unlink(output)
+
+    def test_service_daemonized_by_ctl_missing_command(self):
+        s = self.service("a.pid")
+        s.settings.update({"daemonize": "ctl", "foreground-command": "/no/such/server", "output": os.devnull})
+        self.failUnlessRaises(ActionFailed, s.start)
+        self.failUnless(not os.path.exists("a.pid"))
+
+    def test_settings_fingerprint(self):
+        settings = {"name": "zope0", "start-command": "bin/zope0 start", "env": {"A": "1", "B": "2"}}
+        fingerprint = ctl.settings_fingerprint(settings)
+        self.assertEqual(ctl.settings_fingerprint(dict(settings, **{"stop-timeout": "5", "depends-on": "zeo"})), fingerprint)
+        self.assertNotEqual(ctl.settings_fingerprint(dict(settings, **{"zodb-cache-size": "5000"})), fingerprint)
+
+    def test_apply(self):
+        s = self.services("a.pid", "b.pid", cluster="test")
+        s.start()
+        pids = [service.pid for service in s.services]
+
+        try:
+            # b has changed and c has been added
+            s = self.services("a.pid", "b.pid", "c.pid", cluster="test", settings={"b.pid": {"zodb-cache-size": "5000"}})
+            s.apply()
+            self.assertEqual(s.services[0].pid, pids[0])
+            self.assertNotEqual(s.services[1].pid, pids[1])
+            self.failUnless(s.services[1].alive() and s.services[2].alive())
+
+            # b has been removed
+            s = self.services("a.pid", "c.pid", cluster="test")
+            s.apply()
+            self.failUnless(not self.status_service("b.pid"))
+            self.failUnless(not os.path.exists("b.pid.applied"))
+            self.failUnlessRaises(NothingToDo, s.apply)
+        finally:
+            for pid in ("a.pid", "b.pid", "c.pid"):
+                if self.status_service(pid):
+                    self.raw_stop_service(pid)
+                if os.path.exists(pid + ".applied"):
+                    os.unlink(pid + ".applied")
+
+    def test_get_command_as_root(self):
+        if os.getuid() != 0:
+            return
+        s = self.service("a.pid")
+        s.settings["user"] = "nobody"
+        self.assertEqual(s.get_command("true", "nobody"), ["true"])
+
+    def test_user_environment(self):
+        if os.getuid() != 0:
+            return
+        os.environ["SSH_AUTH_SOCK"] = "/tmp/agent"
+        try:
+            s = self.service("a.pid")
+            s.settings["user"] = "nobody"
+            env, setup = s.child_setup()
+        finally:
+            del os.environ["SSH_AUTH_SOCK"]
+        self.failIf("SSH_AUTH_SOCK" in env)
+        self.assertEqual((env["USER"], env["LOGNAME"], env["HOME"]), ("nobody", "nobody", ctl.lookup_user("nobody")[3]))
+        self.failUnless(env["PATH"])
+        self.assertEqual(env["PYTHONPATH"], ":".join(sys.path))
+
+    def test_spawn_drops_privileges(self):
+        if os.getuid() != 0:
+            return
+        directory = tempfile.mkdtemp()
+        try:
+            os.chmod(directory, 0777)
+            path = os.path.join(directory, "id")
+            s = self.service("a.pid")
+            s.settings["user"] = "nobody"
+            self.assertEqual(s.spawn("sh -c 'id -u > %s; echo $HOME >> %s'" % (path, path)).wait(), 0)
+            uid, gid, groups, home = ctl.lookup_user("nobody")
+            self.assertEqual(open(path).read().split(), [str(uid), home])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_lookup_user_is_cached(self):
+        name = pwd.getpwuid(os.getuid()).pw_name
+        first = ctl.lookup_user(name)
+        self.failUnless(ctl.lookup_user(name) is first)
+        self.assertEqual(first[0], os.getuid())
+
+    def test_auto_pin(self):
+        s = self.services("a.pid", "b.pid", settings={"b.pid": {"cpu-affinity": "0-1"}})
+        s.pin()
+        self.assertEqual(s.services[0].cpu_affinity, [affinity.online_cpus()[0]])
+        self.assertEqual(s.services[1].cpu_affinity, [0, 1])
+
     def test_service_stop_when_not_running(self):
         s = self.service("a.pid")
         self.failUnlessRaises(NothingToDo, s.stop)
@@ -138,10 +401,983 @@ class TestCtl(unittest.TestCase):
         s.stop()
         self.assertEqual(s.status(), 2)
 
+    def test_services_waves(self):
+        s = self.services("a.pid", "b.pid", "c.pid")
+        self.assertEqual([[x.service for x in w] for w in s.waves], [["a.pid"], ["b.pid"], ["c.pid"]])
+
+        s = self.services("a.pid", "b.pid", "c.pid", "d.pid", parallel=True, settings={"b.pid": {"barrier": "true"}})
+        self.assertEqual([[x.service for x in w] for w in s.waves], [["a.pid"], ["b.pid"], ["c.pid", "d.pid"]])
+
+    def test_dependency_waves(self):
+        waves = dependency_waves(["zeo", "zope0", "zope1", "varnish"], {
+            "zope0": ["zeo"],
+            "zope1": ["zeo"],
+            "varnish": ["zope0", "zope1"],
+            })
+        self.assertEqual(waves, [["zeo"], ["zope0", "zope1"], ["varnish"]])
+
+    def test_dependency_waves_cycle(self):
+        self.failUnlessRaises(ValueError, dependency_waves, ["a", "b"], {"a": ["b"], "b": ["a"]})
+        self.failUnlessRaises(ValueError, dependency_waves, ["a"], {"a": ["b"]})
+
+    def test_services_depends_on(self):
+        s = self.services("a.pid", "b.pid", "c.pid", settings={"a.pid": {"depends-on": "c.pid"}})
+        self.assertEqual([[x.service for x in w] for w in s.waves], [["b.pid"], ["c.pid"], ["a.pid"]])
+
+        s = self.services("a.pid", "b.pid", "c.pid", parallel=True, settings={"a.pid": {"depends-on": "c.pid"}})
+        self.assertEqual([[x.service for x in w] for w in s.waves], [["b.pid", "c.pid"], ["a.pid"]])
+
+        s = self.services("a.pid", "b.pid", settings={"a.pid": {"depends-on": "b.pid"}, "b.pid": {"depends-on": "a.pid"}})
+        self.failUnlessRaises(ActionFailed, s.start)
+
+    def test_service_index(self):
+        index = ctl.ServiceIndex([
+            {"name": "zeo", "tags": "db"},
+            {"name": "zope1", "tags": "web zope"},
+            {"name": "zope2", "tags": "web zope"},
+            {"name": "zope10", "tags": "zope"},
+            {"name": "varnish", "tags": "web"},
+            ])
+        self.assertEqual(index.select(["zope1"]), ["zope1"])
+        self.assertEqual(index.select(["zope[2-9]", "zeo"]), ["zeo", "zope2"])
+        self.assertEqual(index.select(["zope*"]), ["zope1", "zope2", "zope10"])
+        self.assertEqual(index.select(["@web"]), ["zope1", "zope2", "varnish"])
+        self.assertEqual(index.select(["@db", "varnish", "zeo"]), ["zeo", "varnish"])
+        self.failUnlessRaises(ActionFailed, index.select, ["zope3"])
+        self.failUnlessRaises(ActionFailed, index.select, ["@cache"])
+        self.failUnlessRaises(ActionFailed, index.select, ["zope1", "squid*"])
+
+    def test_services_select(self):
+        s = self.services("a.pid", "b.pid", "c.pid", settings={"c.pid": {"depends-on": "a.pid"}})
+        selection = s.select(["c.pid"])
+        self.assertEqual([x.service for x in selection.services], ["c.pid"])
+        self.assertEqual(selection.known, set(["a.pid", "b.pid", "c.pid"]))
+        # The dependency on a service that wasn't picked is ignored
+        self.assertEqual([[x.service for x in w] for w in selection.waves], [["c.pid"]])
+
+        selection.start()
+        try:
+            self.assertEqual(s.status(), 2)
+            self.failUnless(self.status_service("c.pid"))
+        finally:
+            selection.stop()
+
+    def test_services_parallel(self):
+        pids = ("a.pid", "b.pid", "c.pid", "d.pid", "e.pid")
+        settings = dict((pid, {"start-command": "%s %s %s start --start-delay 1" % (sys.executable, sibpath("testservice.py"), os.path.realpath(pid))})
+            for pid in pids)
+        settings["c.pid"]["barrier"] = "true"
+        s = self.services(parallel=True, settings=settings, *pids)
+        self.assertEqual(s.status(), 5)
+
+        times = {}
+        def timed(service, start=Service.start):
+            def run():
+                began = time.time()
+                barrier_up = os.path.exists(os.path.realpath("c.pid"))
+                try:
+                    start(service)
+                finally:
+                    times[service.service] = (began, time.time(), barrier_up)
+            service.start = run
+        for service in s.services:
+            timed(service)
+
+        s.start()
+        self.assertEqual(s.status(), 0)
+
+        # Each wave takes about as long as one of its services, not as long as all of them
+        for wave in (("a.pid", "b.pid"), ("d.pid", "e.pid")):
+            took = max(times[pid][1] for pid in wave) - min(times[pid][0] for pid in wave)
+            self.failUnless(took < 1.6, "%s took %.2fs" % (wave, took))
+
+        # Nothing goes past the barrier until it is running
+        self.failUnless(times["c.pid"][0] >= max(times["a.pid"][1], times["b.pid"][1]))
+        self.failIf(times["c.pid"][2])
+        for pid in ("d.pid", "e.pid"):
+            self.failUnless(times[pid][0] >= times["c.pid"][1])
+            self.failUnless(times[pid][2])
+
+        s.stop()
+        self.assertEqual(s.status(), 5)
+
+    def test_run_concurrently_limit(self):
+        lock = threading.Lock()
+        running = [0]
+        most = [0]
+        def action(item):
+            lock.acquire()
+            running[0] += 1
+            most[0] = max(most[0], running[0])
+            lock.release()
+            time.sleep(0.1)
+            lock.acquire()
+            running[0] -= 1
+            lock.release()
+            if item == 3:
+                raise ValueError(item)
+
+        failures = ctl.run_concurrently(action, range(7), 2)
+        self.assertEqual(most[0], 2)
+        self.assertEqual([(item, e.args) for item, e in failures], [(3, (3, ))])
+
+        self.assertEqual(len(ctl.run_concurrently(action, range(5))), 1)
+        self.assertEqual(most[0], 5)
+
+    def test_services_rolling_restart(self):
+        s = self.services("a.pid", "b.pid", "c.pid")
+        s.start()
+        before = [x.pid for x in s.services]
+        s.rolling_restart(2)
+        self.assertEqual(s.status(), 0)
+        after = [x.pid for x in s.services]
+        self.failUnless(not set(before) & set(after))
+        s.stop()
+
+    def test_services_rolling_restart_aborts(self):
+        s = self.services("a.pid", "b.pid", "c.pid")
+        s.start()
+        c = s.services[2].pid
+        s.services[1].settings["start-command"] = "false"
+        self.failUnlessRaises(ActionFailed, s.rolling_restart)
+        self.assertEqual(s.services[2].pid, c)
+        self.assertEqual(s.status(), 1)
+        s.stop()
+
+    def test_services_snapshot(self):
+        s = self.services("a.pid", "b.pid")
+        s.services[0].start()
+        snapshot = s.snapshot()
+        self.assertEqual([x["name"] for x in snapshot], ["a.pid", "b.pid"])
+        self.assertEqual([x["alive"] for x in snapshot], [True, False])
+        self.assertEqual(snapshot[0]["pid"], s.services[0].pid)
+        self.failUnless(snapshot[0]["rss"] > 0)
+        self.failUnless(snapshot[0]["uptime"] >= 0)
+        self.failUnless("cpu_time" in snapshot[0])
+        self.failUnless("rss" not in snapshot[1])
+        s.stop()
+
+    def test_procfs_process_info(self):
+        info = procfs.process_info(os.getpid())
+        self.failUnless(info["rss"] > 0)
+        self.failUnless(info["start_time"] <= time.time())
+        self.assertEqual(procfs.process_info(2 ** 22 + 1), None)
+        self.failUnless(os.getpid() in procfs.running_pids())
+
+    def test_service_start_waits_for_probe(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        s = self.service("a.pid")
+        s.settings["ready-tcp"] = "127.0.0.1:%d" % listener.getsockname()[1]
+        s.settings["ready-timeout"] = "0.5"
+        self.failUnlessRaises(ActionFailed, s.start)
+        self.failUnless(s.alive() and not s.ready())
+        self.raw_stop_service("a.pid")
+
+        listener.listen(5)
+        s.start()
+        self.failUnless(s.ready())
+        s.stop()
+        listener.close()
+
+    def test_service_start_bad_probe(self):
+        s = self.service("a.pid")
+        s.settings["ready-tcp"] = "127.0.0.1"
+        self.failUnlessRaises(ActionFailed, s.start)
+        self.failIf(s.alive())
+
+    def test_supervisor(self):
+        sock = os.path.realpath("cluster.sock")
+        backoff = {"restart-backoff": "0.1", "max-restarts": "1"}
+        daemon = supervisor.Supervisor(self.services("a.pid", "b.pid", settings={"a.pid": backoff}), sock)
+        t = threading.Thread(target=daemon.serve)
+        t.start()
+        try:
+            self.failUnless(events.wait_for(lambda: supervisor.connect(sock), 10))
+            client = supervisor.connect(sock)
+            self.failUnless(events.wait_for(lambda: client.request("status")["not_running"] == 0, 30))
+
+            listener = "socket:[%d]" % os.fstat(daemon.listener.fileno()).st_ino
+            for service in daemon.services.services:
+                self.failIf(listener in open_files(service.pid))
+
+            pid = daemon.services.services[0].pid
+            os.kill(pid, 9)
+            restarted = lambda: client.request("status")["services"][0]["restarts"] == 1
+            self.failUnless(events.wait_for(restarted, 30))
+            self.failUnless(events.wait_for(lambda: client.request("status")["not_running"] == 0, 30))
+            self.failIfEqual(daemon.services.services[0].pid, pid)
+
+            os.kill(daemon.services.services[0].pid, 9)
+            failed = lambda: client.request("status")["services"][0]["failed"]
+            self.failUnless(events.wait_for(failed, 30))
+            self.assertEqual(client.request("status")["services"][0]["restarts"], 1)
+
+            self.assertEqual(client.request("stop", services=["b.pid"]), {"ok": True})
+            status = client.request("status", services=["b.pid"])
+            self.assertEqual([state["name"] for state in status["services"]], ["b.pid"])
+            self.failIf(status["services"][0]["supervised"])
+            self.assertEqual(status["not_running"], 1)
+            self.failUnless("error" in client.request("start", services=["z.pid"]))
+
+            self.assertEqual(client.request("stop"), {"ok": True})
+            self.assertEqual(client.request("status")["not_running"], 2)
+        finally:
+            daemon.running = False
+            t.join()
+        self.failUnless(not os.path.exists(sock))
+
+
+    def test_supervisor_survives_errors(self):
+        sock = os.path.realpath("cluster.sock")
+        daemon = supervisor.Supervisor(self.services("a.pid", settings={"a.pid": {"restart-backoff": "0.1"}}), sock)
+        t = threading.Thread(target=daemon.serve)
+        t.start()
+        stderr = sys.stderr
+        try:
+            self.failUnless(events.wait_for(lambda: supervisor.connect(sock), 10))
+            client = supervisor.connect(sock)
+            self.failUnless(events.wait_for(lambda: client.request("status")["not_running"] == 0, 30))
+
+            def broken():
+                raise IOError(28, "No space left on device")
+            service = daemon.services.services[0]
+            service.start = broken
+            sys.stderr = StringIO.StringIO()
+
+            # Neither a restart nor a request that fails unexpectedly stops the supervisor
+            os.kill(service.pid, 9)
+            restarted = lambda: client.request("status")["services"][0]["restarts"] == 1
+            self.failUnless(events.wait_for(restarted, 30))
+            self.failUnless("No space left on device" in client.request("start")["error"])
+            self.failUnless(t.isAlive())
+            self.failUnless("failed to restart" in sys.stderr.getvalue())
+            self.failUnless(supervisor.connect(sock))
+        finally:
+            sys.stderr = stderr
+            daemon.running = False
+            t.join()
+            if self.status_service("a.pid"):
+                self.raw_stop_service("a.pid")
+
+    def test_supervisor_apply(self):
+        sock = os.path.realpath("cluster.sock")
+        configs = [self.services("a.pid", "b.pid", cluster="test")]
+        daemon = supervisor.Supervisor(configs[0], sock, reload=lambda: configs[-1])
+        t = threading.Thread(target=daemon.serve)
+        t.start()
+        try:
+            self.failUnless(events.wait_for(lambda: supervisor.connect(sock), 10))
+            client = supervisor.connect(sock)
+            self.failUnless(events.wait_for(lambda: client.request("status")["not_running"] == 0, 30))
+
+            pids = [service.pid for service in daemon.services.services]
+            self.assertEqual(client.request("rolling-restart", batch_size=2), {"ok": True})
+            self.failIf(set(pids) & set(service.pid for service in daemon.services.services))
+
+            # b has been removed and c added
+            configs.append(self.services("a.pid", "c.pid", cluster="test"))
+            self.assertEqual(client.request("apply"), {"ok": True})
+            self.failUnless(not self.status_service("b.pid"))
+            self.assertEqual(daemon.wanted, set(["a.pid", "c.pid"]))
+
+            # Let the supervisor look for crashes
+            time.sleep(daemon.check_interval * 2)
+            status = client.request("status")
+            self.assertEqual([state["name"] for state in status["services"]], ["a.pid", "c.pid"])
+            self.assertEqual(status["not_running"], 0)
+            self.assertEqual([state["restarts"] for state in status["services"]], [0, 0])
+            self.failUnless(not self.status_service("b.pid"))
+
+            client.request("stop")
+        finally:
+            daemon.running = False
+            t.join()
+            for pid in ("a.pid", "b.pid", "c.pid"):
+                if self.status_service(pid):
+                    self.raw_stop_service(pid)
+                if os.path.exists(pid + ".applied"):
+                    os.unlink(pid + ".applied")
+
+    def test_supervisor_metrics(self):
+        sock = os.path.realpath("cluster.sock")
+        history = timings.History(os.path.realpath("cluster.timings"))
+        daemon = supervisor.Supervisor(self.services("a.pid", cluster="test"), sock, history=history,
+            metrics_address=("127.0.0.1", 0), metrics_interval=0)
+        t = threading.Thread(target=daemon.serve)
+        t.start()
+        try:
+            self.failUnless(events.wait_for(lambda: supervisor.connect(sock), 10))
+            client = supervisor.connect(sock)
+            self.failUnless(events.wait_for(lambda: client.request("status")["not_running"] == 0, 30))
+
+            import urllib2
+            response = urllib2.urlopen("http://127.0.0.1:%d/metrics" % daemon.metrics_server.server_address[1])
+            self.assertEqual(response.info()["Content-Type"], metrics.CONTENT_TYPE)
+            lines = response.read().splitlines()
+            self.failUnless('cluster_service_up{cluster="test",service="a.pid"} 1' in lines)
+            self.failUnless('cluster_service_restarts_total{cluster="test",service="a.pid"} 0' in lines)
+            self.failUnless('cluster_service_start_duration_seconds_count{cluster="test",service="a.pid"} 1' in lines)
+            self.assertEqual(lines[-1], "# EOF")
+
+            self.failUnless("cluster_service_pid" in client.request("metrics")["metrics"])
+            client.request("stop")
+        finally:
+            daemon.running = False
+            t.join()
+            os.unlink("cluster.timings")
+        self.failUnless(daemon.metrics_server is None)
+
+
+    def test_supervisor_metrics_restart(self):
+        sock = os.path.realpath("cluster.sock")
+        services = self.services("a.pid")
+        first = supervisor.Supervisor(services, sock, metrics_address=("127.0.0.1", 0))
+        t = threading.Thread(target=first.serve)
+        t.start()
+        try:
+            self.failUnless(events.wait_for(lambda: supervisor.connect(sock), 10))
+            self.failUnless(events.wait_for(lambda: supervisor.connect(sock).request("status")["not_running"] == 0, 30))
+            port = first.metrics_server.server_address[1]
+            import fcntl
+            self.failUnless(fcntl.fcntl(first.metrics_server.fileno(), fcntl.F_GETFD) & fcntl.FD_CLOEXEC)
+        finally:
+            first.running = False
+            t.join()
+
+        # The service is still running, and mustn't be holding the port
+        import urllib2
+        second = supervisor.Supervisor(self.services("a.pid"), sock, metrics_address=("127.0.0.1", port))
+        t = threading.Thread(target=second.serve)
+        t.start()
+        try:
+            def scraped():
+                try:
+                    return "cluster_service_up" in urllib2.urlopen("http://127.0.0.1:%d/metrics" % port).read()
+                except IOError:
+                    return False
+            self.failUnless(events.wait_for(scraped, 10))
+        finally:
+            second.running = False
+            t.join()
+            services.stop()
+
+    def test_supervisor_metrics_port_in_use(self):
+        sock = os.path.realpath("cluster.sock")
+        taken = socket.socket()
+        taken.bind(("127.0.0.1", 0))
+        taken.listen(1)
+        try:
+            daemon = supervisor.Supervisor(self.services("a.pid"), sock, metrics_address=taken.getsockname())
+            self.failUnlessRaises(ActionFailed, daemon.listen)
+            self.failUnless(not os.path.exists(sock))
+        finally:
+            taken.close()
+
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "cluster.cfg")
+
+        self.config = ConfigParser.RawConfigParser()
+        self.config.add_section("cluster")
+        self.config.set("cluster", "name", "cluster")
+        self.config.set("cluster", "services", "zope0")
+        self.config.add_section("zope0")
+        self.config.set("zope0", "name", "zope0")
+        self.config.set("zope0", "pidfile", "/tmp/zope0.pid")
+        self.config.set("zope0", "recipe", "plone.recipe.zope2instance")
+        self.config.write(open(self.path, "w"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_without_manifest(self):
+        cluster, services = ctl.load_config(self.path)
+        self.assertEqual(cluster["name"], "cluster")
+        self.assertEqual(services[0]["recipe"], "plone.recipe.zope2instance")
+
+    def test_manifest(self):
+        ctl.write_manifest(self.path, self.config)
+        cluster, services = ctl.read_manifest(self.path)
+        self.assertEqual(cluster["name"], "cluster")
+        self.assertEqual(services, [{"name": "zope0", "pidfile": "/tmp/zope0.pid"}])
+        self.assertEqual(ctl.load_config(self.path), (cluster, services))
+
+    def test_stale_manifest(self):
+        ctl.write_manifest(self.path, self.config)
+        open(self.path, "a").write("\n# edited by hand\n")
+        self.assertEqual(ctl.read_manifest(self.path), None)
+        cluster, services = ctl.load_config(self.path)
+        self.assertEqual(services[0]["recipe"], "plone.recipe.zope2instance")
+
+    def test_corrupt_manifest(self):
+        open(ctl.manifest_path(self.path), "w").write("junk")
+        self.assertEqual(ctl.read_manifest(self.path), None)
+
+
+FAKE_SSH = """#!/bin/sh
+# Runs the command here instead of on the host, and notes which host it was for
+while true; do
+    case "$1" in
+        -O) shift 2; echo "exit $1" >> %(log)s; exit 0 ;;
+        -o) shift 2 ;;
+        -*) shift ;;
+        *) break ;;
+    esac
+done
+echo "$1" >> %(log)s
+shift
+exec sh -c "$*"
+"""
+
+LAUNCHER = """#!%(python)s
+import sys
+sys.path[0:0] = %(path)r
+from isotoma.recipe.cluster.ctl import main
+sys.exit(main(%(cfg)r))
+"""
+
+
+class TestRemote(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmpdir, "ssh.log")
+        self.cfg = os.path.join(self.tmpdir, "cluster.cfg")
+        os.mkdir(os.path.join(self.tmpdir, "var"))
+
+        ssh = self.script("ssh", FAKE_SSH % {"log": self.log})
+        launcher = self.script("cluster", LAUNCHER % {"python": sys.executable, "path": sys.path, "cfg": self.cfg})
+
+        config = ConfigParser.RawConfigParser()
+        config.add_section("cluster")
+        for key, value in (("name", "cluster"), ("services", "a b"), ("user", ""), ("owner", "root"),
+                ("bindir", self.tmpdir), ("varrundir", os.path.join(self.tmpdir, "var")),
+                ("ssh", ssh), ("remote-script", launcher)):
+            config.set("cluster", key, value)
+        for name, host in (("a", "app1"), ("b", "app2")):
+            pidfile = os.path.join(self.tmpdir, "%s.pid" % name)
+            command = " ".join((sys.executable, sibpath("testservice.py"), pidfile))
+            config.add_section(name)
+            for key, value in (("name", name), ("hosts", host), ("pidfile", pidfile),
+                    ("start-command", command + " start"), ("stop-command", command + " stop")):
+                config.set(name, key, value)
+        config.write(open(self.cfg, "w"))
+
+    def tearDown(self):
+        self.main("stop")
+        shutil.rmtree(self.tmpdir)
+
+    def script(self, name, body):
+        path = os.path.join(self.tmpdir, name)
+        open(path, "w").write(body)
+        os.chmod(path, 0755)
+        return path
+
+    def main(self, *args):
+        argv, stdout = sys.argv, sys.stdout
+        sys.argv = ["cluster"] + list(args)
+        sys.stdout = StringIO.StringIO()
+        try:
+            status = ctl.main(self.cfg)
+            return status, sys.stdout.getvalue()
+        finally:
+            sys.argv, sys.stdout = argv, stdout
+
+    def test_split_hosts(self):
+        local, hosts = remote.split_hosts([{"name": "a", "hosts": "app1 app2"}, {"name": "b"}, {"name": "c", "hosts": "app2"}])
+        self.assertEqual(local, [{"name": "b"}])
+        self.assertEqual(hosts, {"app1": ["a"], "app2": ["a", "c"]})
+
+    def test_host_waves(self):
+        zeo, client = {"name": "zeo"}, {"name": "zope", "hosts": "app1", "depends-on": "zeo"}
+        self.assertEqual(remote.host_waves([zeo, client]), [["zeo"], ["zope"]])
+        self.assertEqual(remote.host_waves([zeo, dict(client, hosts="")]), None)
+        self.assertEqual(remote.host_waves([client]), None)
+        self.assertRaises(ctl.ActionFailed, remote.host_waves, [dict(zeo, **{"depends-on": "zope"}), client])
+
+    def test_waves_across_hosts(self):
+        config = ConfigParser.RawConfigParser()
+        config.read(self.cfg)
+        config.set("b", "depends-on", "a")
+        config.write(open(self.cfg, "w"))
+
+        self.assertEqual(self.main("start")[0], 0)
+        log = [line for line in open(self.log).read().splitlines() if not line.startswith("exit")]
+        self.assertEqual(log, ["app1", "app2"])
+
+        open(self.log, "w").close()
+        self.assertEqual(self.main("stop")[0], 0)
+        log = [line for line in open(self.log).read().splitlines() if not line.startswith("exit")]
+        self.assertEqual(log, ["app2", "app1"])
+
+    def test_status(self):
+        status, output = self.main("status")
+        self.assertEqual(status, 2)
+        lines = output.splitlines()
+        self.assertEqual(lines[0].split(), ["HOST", "SERVICE", "STATE", "PID"])
+        self.assertEqual([line.split()[:3] for line in lines[1:]], [["app1", "a", "stopped"], ["app2", "b", "stopped"]])
+
+    def test_start_and_stop(self):
+        status, output = self.main("start")
+        self.assertEqual(status, 0)
+        self.failUnless("app1: Attempting to start a" in output.splitlines())
+
+        status, output = self.main("status")
+        self.assertEqual(status, 0)
+        self.assertEqual([line.split()[2] for line in output.splitlines()[1:]], ["running", "running"])
+
+        status, output = self.main("--service", "b", "stop")
+        self.assertEqual(status, 0)
+        self.assertEqual(self.main("status")[0], 1)
+
+        # One connection per host each run, closed at the end
+        log = open(self.log).read().splitlines()
+        self.assertEqual(sorted(log[:4]), ["app1", "app2", "exit app1", "exit app2"])
+
+    def test_selection(self):
+        status, output = self.main("start", "b*")
+        self.assertEqual(status, 0)
+        # Only the host running the selected service is contacted
+        self.assertEqual(open(self.log).read().splitlines(), ["app2", "exit app2"])
+
+        status, output = self.main("status", "a", "b")
+        self.assertEqual([line.split()[:3] for line in output.splitlines()[1:]], [["app1", "a", "stopped"], ["app2", "b", "running"]])
+
+        self.assertEqual(self.main("stop", "c*")[0], 1)
+
+    def test_one_control_dir(self):
+        created = []
+        mkdtemp = tempfile.mkdtemp
+        def slow_mkdtemp(*args, **kwargs):
+            # Give the other threads time to race for the directory
+            time.sleep(0.1)
+            created.append(mkdtemp(*args, **kwargs))
+            return created[-1]
+
+        hosts = dict(("app%d" % i, ["a"]) for i in range(8))
+        pool = remote.SshPool(self.script("ssh", FAKE_SSH % {"log": self.log}))
+        tempfile.mkdtemp = slow_mkdtemp
+        try:
+            results = remote.RemoteHosts(pool, "true", hosts).run("status")
+        finally:
+            tempfile.mkdtemp = mkdtemp
+        self.assertEqual([status for status, output in results.values()], [0] * 8)
+        self.assertEqual(len(created), 1)
+
+        pool.close()
+        self.failIf(os.path.exists(created[0]))
+        exits = [line for line in open(self.log).read().splitlines() if line.startswith("exit")]
+        self.assertEqual(sorted(exits), sorted("exit %s" % host for host in hosts))
+
+    def test_unreachable_host(self):
+        self.script("ssh", "#!/bin/sh\necho connection refused\nexit 255\n")
+        status, output = self.main("status")
+        self.assertEqual(status, 2)
+        self.failUnless("unknown: connection refused" in output)
+
+
+class TestTimings(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_timer(self):
+        records = []
+        with timings.Timer("zope0", "start", records.append) as timer:
+            timer.mark("exec")
+        self.assertEqual(records[0]["service"], "zope0")
+        self.assertEqual(records[0]["ok"], True)
+        self.assertEqual([phase for phase, duration in records[0]["phases"]], ["exec"])
+
+    def test_timer_failed(self):
+        records = []
+        def fail():
+            with timings.Timer("zope0", "start", records.append):
+                raise ActionFailed("oops")
+        self.failUnlessRaises(ActionFailed, fail)
+        self.assertEqual(records[0]["ok"], False)
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(timings.percentile(values, 50), 50)
+        self.assertEqual(timings.percentile(values, 95), 95)
+        self.assertEqual(timings.percentile([3], 95), 3)
+        self.assertEqual(timings.percentile([], 50), None)
+
+    def test_history(self):
+        history = timings.History(os.path.join(self.tmpdir, "cluster.timings"))
+        self.assertEqual(history.read(), [])
+        history.append([{"service": "a", "action": "start", "total": t, "ok": True} for t in (1.0, 2.0, 3.0)])
+        history.append([{"service": "a", "action": "start", "total": 9.0, "ok": False}])
+        summary = timings.summarise(history.read())
+        self.assertEqual(summary[("a", "start")], {"count": 3, "p50": 2.0, "p95": 3.0, "max": 3.0})
+
+    def test_history_is_trimmed(self):
+        history = timings.History(os.path.join(self.tmpdir, "cluster.timings"), max_size=2000)
+        for t in range(200):
+            history.append([{"service": "a", "action": "start", "total": float(t), "ok": True}])
+            self.failUnless(os.path.getsize(history.path) <= 2000)
+        totals = [timing["total"] for timing in history.read()]
+        self.failUnless(10 < len(totals) < 50)
+        self.assertEqual(totals, [float(t) for t in range(200 - len(totals), 200)])
+        self.assertEqual(os.listdir(self.tmpdir), ["cluster.timings"])
+
+
+class FakeServices(object):
+
+    cluster = "test"
+
+    def __init__(self, snapshot):
+        self.state = snapshot
+        self.snapshots = 0
+
+    def snapshot(self):
+        self.snapshots += 1
+        return [dict(state) for state in self.state]
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.now = 1000.0
+        self.services = FakeServices([
+            {"name": "zeo", "pid": 10, "alive": True, "start_time": 900.5, "rss": 4096, "cpu_time": 1.5},
+            {"name": "zope\"1\"", "pid": None, "alive": False},
+            ])
+        self.history = timings.History(os.path.join(self.tmpdir, "cluster.timings"))
+        self.collector = metrics.Collector(self.services, self.history, interval=5, restarts={"zeo": 2}, clock=lambda: self.now)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_histogram(self):
+        h = metrics.histogram([0.05, 0.3, 7.0], buckets=(0.1, 1.0))
+        self.assertEqual(h["buckets"], [(0.1, 1), (1.0, 2), (float("inf"), 3)])
+        self.assertEqual(h["count"], 3)
+
+    def test_render(self):
+        self.history.append([
+            {"service": "zeo", "action": "start", "total": 0.2, "ok": True},
+            {"service": "zeo", "action": "start", "total": 9.0, "ok": False},
+            {"service": "zeo", "action": "stop", "total": 3.0, "ok": True},
+            ])
+        lines = self.collector.render().splitlines()
+        self.assertEqual(lines[:2], ["# TYPE cluster_service_up gauge", "# HELP cluster_service_up Whether the service is running."])
+        for line in (
+                'cluster_service_up{cluster="test",service="zeo"} 1',
+                'cluster_service_up{cluster="test",service="zope\\"1\\""} 0',
+                'cluster_service_pid{cluster="test",service="zeo"} 10',
+                'cluster_service_start_time_seconds{cluster="test",service="zeo"} 900.5',
+                'cluster_service_resident_memory_bytes{cluster="test",service="zeo"} 4096',
+                'cluster_service_cpu_seconds_total{cluster="test",service="zeo"} 1.5',
+                'cluster_service_restarts_total{cluster="test",service="zeo"} 2',
+                'cluster_service_start_duration_seconds_bucket{cluster="test",le="0.25",service="zeo"} 1',
+                'cluster_service_start_duration_seconds_count{cluster="test",service="zeo"} 1',
+                'cluster_service_stop_duration_seconds_bucket{cluster="test",le="2.5",service="zeo"} 0',
+                'cluster_service_stop_duration_seconds_bucket{cluster="test",le="+Inf",service="zeo"} 1',
+                'cluster_service_stop_duration_seconds_sum{cluster="test",service="zeo"} 3.0',
+                ):
+            self.failUnless(line in lines, line)
+        self.failIf([line for line in lines if line.startswith("cluster_service_pid") and "zope" in line])
+        self.assertEqual(lines[-1], "# EOF")
+
+    def test_cached(self):
+        self.collector.render()
+        self.collector.render()
+        self.assertEqual(self.services.snapshots, 1)
+
+        self.history.append([{"service": "zeo", "action": "start", "total": 0.2, "ok": True}])
+        self.now += 5
+        self.failUnless("cluster_service_start_duration_seconds_count" in self.collector.render())
+        self.assertEqual(self.services.snapshots, 2)
+
+        # An unchanged history isn't read again
+        self.history.read = lambda: self.fail("history was read again")
+        self.now += 5
+        self.collector.render()
+
+    def test_parse_address(self):
+        self.assertEqual(metrics.parse_address("127.0.0.1:9101"), ("127.0.0.1", 9101))
+        self.assertEqual(metrics.parse_address("9101"), ("", 9101))
+
+
+class TestRestartPolicy(unittest.TestCase):
+
+    def test_backoff(self):
+        policy = supervisor.RestartPolicy(backoff=1, max_restarts=3, window=60, random=lambda: 1.0)
+        self.assertEqual([policy.crashed(0), policy.crashed(1), policy.crashed(2)], [1, 2, 4])
+        self.assertEqual(policy.crashed(3), None)
+        self.failUnless(policy.failed)
+        policy.reset()
+        self.assertEqual(policy.crashed(4), 1)
+
+    def test_jitter(self):
+        policy = supervisor.RestartPolicy(backoff=4, random=lambda: 0.0)
+        self.assertEqual(policy.crashed(0), 2)
+
+    def test_window(self):
+        policy = supervisor.RestartPolicy(backoff=1, max_restarts=1, window=10, random=lambda: 1.0)
+        self.assertEqual(policy.crashed(0), 1)
+        self.assertEqual(policy.crashed(11), 1)
+        self.assertEqual(policy.crashed(12), None)
+
+
+class TestProbes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_tcp(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        probe = probes.TcpProbe("127.0.0.1:%d" % listener.getsockname()[1])
+        self.failUnless(not probe())
+        listener.listen(1)
+        self.failUnless(probe())
+        listener.close()
+
+    def test_http(self):
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200 if self.path == "/ok" else 503)
+                self.end_headers()
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        base = "http://127.0.0.1:%d" % server.server_address[1]
+        self.failUnless(probes.HttpProbe(base + "/ok")())
+        self.failUnless(not probes.HttpProbe(base + "/warming-up")())
+        server.shutdown()
+        server.server_close()
+        self.failUnless(not probes.HttpProbe(base + "/ok")())
+
+    def test_socket(self):
+        path = os.path.join(self.tmpdir, "sock")
+        probe = probes.SocketProbe(path)
+        self.failUnless(not probe())
+        listener = socket.socket(socket.AF_UNIX)
+        listener.bind(path)
+        listener.listen(1)
+        self.failUnless(probe())
+        listener.close()
+
+    def test_get_probes(self):
+        found = probes.get_probes({"ready-tcp": "127.0.0.1:8080", "ready-http": "http://127.0.0.1:8080/ok"})
+        self.assertEqual([p.__class__ for p in found], [probes.TcpProbe, probes.HttpProbe])
+
+    def test_get_probes_bad_address(self):
+        for target in ("127.0.0.1", "localhost:http", ":8080"):
+            self.assertRaises(ActionFailed, probes.get_probes, {"ready-tcp": target})
+        self.assertEqual(probes.parse_address(" [::1]:8080 "), ("::1", 8080))
+
+
+class TestEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_wait_for_file(self):
+        path = os.path.join(self.tmpdir, "a.pid")
+        t = threading.Timer(0.2, lambda: open(path, "w").write("1"))
+        t.start()
+        started = time.time()
+        self.failUnless(events.wait_for(lambda: os.path.exists(path), 10, directory=self.tmpdir))
+        self.failUnless(time.time() - started < 5)
+        t.join()
+
+    def test_wait_for_exit(self):
+        p = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(0.2)"])
+        t = threading.Thread(target=p.wait)
+        t.start()
+        self.failUnless(events.wait_for(lambda: p.returncode is not None, 10, pid=p.pid))
+        t.join()
+
+    def test_wait_for_timeout(self):
+        started = time.time()
+        self.failUnless(not events.wait_for(lambda: False, 0.3, directory=self.tmpdir))
+        self.failUnless(time.time() - started >= 0.3)
+
+    def test_wait_for_without_watches(self):
+        calls = []
+        self.failUnless(events.wait_for(lambda: calls.append(1) or len(calls) > 3, 10))
+
+
+class TestAffinity(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sysfs = affinity.SYSFS
+        affinity.SYSFS = self.tmpdir
+
+    def tearDown(self):
+        affinity.SYSFS = self.sysfs
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, data):
+        path = os.path.join(self.tmpdir, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, "w").write(data + "\n")
+
+    def test_parse_cpus(self):
+        self.assertEqual(affinity.parse_cpus("0-3,8, 10-11"), [0, 1, 2, 3, 8, 10, 11])
+        self.assertEqual(affinity.format_cpus([11, 0, 1, 2, 3, 8, 10]), "0-3,8,10-11")
+
+    def test_spread_across_nodes(self):
+        self.write("cpu/online", "0-7")
+        self.write("node/node0/cpulist", "0-3")
+        self.write("node/node1/cpulist", "4-7")
+        self.assertEqual(affinity.spread(10), [0, 4, 1, 5, 2, 6, 3, 7, 0, 4])
+
+    def test_spread_across_cores(self):
+        # Siblings have adjacent numbers, so cpus 0 and 1 are the same core
+        self.write("cpu/online", "0-7")
+        self.write("node/node0/cpulist", "0-3")
+        self.write("node/node1/cpulist", "4-7")
+        for cpu in range(8):
+            self.write("cpu/cpu%d/topology/physical_package_id" % cpu, str(cpu / 4))
+            self.write("cpu/cpu%d/topology/core_id" % cpu, str(cpu % 4 / 2))
+        self.assertEqual(affinity.spread(8), [0, 4, 2, 6, 1, 5, 3, 7])
+
+    def test_spread_without_numa(self):
+        self.write("cpu/online", "0-1,3")
+        self.assertEqual(affinity.spread(4), [0, 1, 3, 0])
+
+
+class TestLogs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "a.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_rotate(self):
+        log = logs.LogFile(self.path, max_bytes=10, backups=2)
+        for line in ("first\n", "second\n", "third\n", "fourth\n"):
+            log.write(line)
+        log.close()
+        self.assertEqual(open(self.path).read(), "fourth\n")
+        self.assertEqual(open(self.path + ".1").read(), "third\n")
+        self.assertEqual(open(self.path + ".2").read(), "second\n")
+        self.failUnless(not os.path.exists(self.path + ".3"))
+
+    def test_pump(self):
+        r, w = os.pipe()
+        log = logs.LogFile(self.path, flush_interval=0.1)
+        t = threading.Thread(target=log.pump, args=(r, ))
+        t.start()
+        os.write(w, "hello\n")
+        self.failUnless(events.wait_for(lambda: os.path.exists(self.path) and open(self.path).read(), 10))
+        os.write(w, "world\n")
+        os.close(w)
+        t.join(10)
+        os.close(r)
+        self.assertEqual(open(self.path).read(), "hello\nworld\n")
+
+    def test_removed(self):
+        log = logs.LogFile(self.path, max_bytes=10, backups=2)
+        log.write("first\n")
+        # Rotated away by someone else, then rotated by us
+        os.rename(self.path, self.path + ".old")
+        log.write("second\n")
+        self.assertEqual(open(self.path).read(), "second\n")
+        os.unlink(self.path)
+        log.write("third\n")
+        self.assertEqual(open(self.path).read(), "third\n")
+        log.close()
+
+    def test_unwritable(self):
+        directory = os.path.join(self.tmpdir, "logs")
+        os.mkdir(directory)
+        log = logs.LogFile(os.path.join(directory, "a.log"))
+        log.write("first\n")
+        shutil.rmtree(directory)
+        log.write("lost\n")
+        self.assertEqual(log.dropped, 5)
+        os.mkdir(directory)
+        log.write("back\n")
+        log.close()
+        self.assertEqual(open(log.path).read(), "[5 bytes of output were lost]\nback\n")
+
+    def test_pump_survives_removed_directory(self):
+        directory = os.path.join(self.tmpdir, "logs")
+        os.mkdir(directory)
+        r, w = os.pipe()
+        log = logs.LogFile(os.path.join(directory, "a.log"), flush_interval=0.01)
+        t = threading.Thread(target=log.pump, args=(r, ))
+        t.start()
+        shutil.rmtree(directory)
+        os.write(w, "lost\n")
+        self.failUnless(events.wait_for(lambda: log.dropped, 10))
+        # Still reading, so whoever writes to the pipe carries on
+        os.write(w, "more\n")
+        os.close(w)
+        t.join(10)
+        os.close(r)
+        self.failUnless(not t.isAlive())
+        self.assertEqual(log.dropped, 10)
+
+    def test_tail(self):
+        open(self.path, "w").write("".join("line %d\n" % i for i in range(5000)))
+        self.assertEqual(logs.tail(self.path, 2), "line 4998\nline 4999\n")
+        self.assertEqual(logs.tail(self.path, 0), "")
+
+    def test_follow(self):
+        class Done(Exception):
+            pass
+
+        class Out(object):
+            data = ""
+            def write(self, data):
+                self.data += data
+                if "after" in self.data:
+                    raise Done()
+            def flush(self):
+                pass
+
+        open(self.path, "w").write("before\n")
+        out = Out()
+        def follow():
+            try:
+                logs.follow(self.path, 1, True, out)
+            except Done:
+                pass
+        t = threading.Thread(target=follow)
+        t.start()
+        time.sleep(0.2)
+        # Rotated, then written to
+        os.rename(self.path, self.path + ".1")
+        open(self.path, "w").write("after\n")
+        t.join(10)
+        self.failUnless(not t.isAlive())
+        self.assertEqual(out.data, "before\nafter\n")
+
 
 def test_suite():
     tests = [
         "doctests/simple-usage.txt",
+        "doctests/dependencies.txt",
+        "doctests/fast-launcher.txt",
         ]
 
     suites = []
@@ -151,6 +1387,15 @@ def test_suite():
             optionflags=doctest.ELLIPSIS, checker=checker))
 
     suites.append(unittest.TestLoader().loadTestsFromTestCase(TestCtl))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(TestEvents))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(TestProbes))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(TestRestartPolicy))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(TestTimings))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(TestMetrics))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(TestConfig))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(TestAffinity))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(TestLogs))
+    suites.append(unittest.TestLoader().loadTestsFromTestCase(TestRemote))
 
     return unittest.TestSuite(suites)
 
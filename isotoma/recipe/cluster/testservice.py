@@ -1,17 +1,23 @@
 #!/usr/bin/env python
 
-import sys, os, time, atexit
-from signal import SIGTERM
+import sys, os, time, atexit, signal, optparse, random
+from signal import SIGTERM, SIGKILL
 
 from isotoma.recipe.cluster.ctl import BaseService
 
 class TestService(BaseService):
 
-    def __init__(self, pidfile, stdin='/dev/null', stdout='/dev/null', stderr='/dev/null'):
+    def __init__(self, pidfile, stdin='/dev/null', stdout='/dev/null', stderr='/dev/null', ignore_term=False, stop_timeout=10,
+            start_delay=0, stop_delay=0, fail_rate=0):
         self.stdin = stdin
         self.stdout = stdout
         self.stderr = stderr
         self.pidfile = pidfile
+        self.ignore_term = ignore_term
+        self.stop_timeout = stop_timeout
+        self.start_delay = start_delay
+        self.stop_delay = stop_delay
+        self.fail_rate = fail_rate
 
     def fork(self):
         try:
@@ -41,9 +47,21 @@ class TestService(BaseService):
         os.dup2(so.fileno(), sys.stdout.fileno())
         os.dup2(se.fileno(), sys.stderr.fileno())
 
+        # Pretend to be a slow starting service
+        time.sleep(self.start_delay)
+
         atexit.register(self.cleanup)
         open(self.pidfile,'w').write("%s" % os.getpid())
 
+        # Exit properly so the pidfile is cleaned up. SIGUSR1 asks us to drain,
+        # which for a service with nothing in flight means exit straight away.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN if self.ignore_term else self.exit)
+        signal.signal(signal.SIGUSR1, self.exit)
+
+    def exit(self, signum, frame):
+        time.sleep(self.stop_delay)
+        sys.exit(0)
+
     def cleanup(self):
         if os.path.exists(self.pidfile):
             os.remove(self.pidfile)
@@ -53,6 +71,10 @@ class TestService(BaseService):
             print >>sys.stderr, "Daemon is already running, can't start again"
             return 1
 
+        if random.random() < self.fail_rate:
+            print >>sys.stderr, "Daemon failed to start"
+            return 1
+
         self.daemonize()
         self.run()
 
@@ -63,16 +85,29 @@ class TestService(BaseService):
             print >>sys.stderr, "Daemon is not running, can't stop"
             return 1
 
-        while True:
-            try:
-                os.kill(self.pid, SIGTERM)
-                time.sleep(1)
+        pid = self.pid
+        try:
+            os.kill(pid, SIGTERM)
+            for i in range(int(self.stop_timeout * 10)):
+                time.sleep(0.1)
                 if not self.alive():
-                    return
-            except OSError, err:
-                print str(err)
-                return 1
+                    return 0
+            print >>sys.stderr, "Daemon ignored SIGTERM, killing it"
+            os.kill(pid, SIGKILL)
+            self.cleanup()
+        except OSError, err:
+            print str(err)
+            return 1
+
+        return 0
 
+    def foreground(self):
+        """ I run without daemonizing, for something else to daemonize and keep the pidfile for """
+        print "Running in the foreground"
+        sys.stdout.flush()
+        signal.signal(signal.SIGTERM, signal.SIG_IGN if self.ignore_term else self.exit)
+        signal.signal(signal.SIGUSR1, self.exit)
+        self.run()
         return 0
 
     def restart(self):
@@ -85,18 +120,34 @@ class TestService(BaseService):
 
 
 def main():
-    if len(sys.argv) != 3:
-        print >>sys.stderr, "%s (start|stop|restart)" % sys.argv[0]
+    parser = optparse.OptionParser(usage="%prog pidfile (start|stop|restart|fg)")
+    parser.add_option("--ignore-term", action="store_true", default=False,
+        help="ignore SIGTERM, to test stop escalation")
+    parser.add_option("--stop-timeout", type="float", default=10,
+        help="how long stop waits after SIGTERM before using SIGKILL")
+    parser.add_option("--start-delay", type="float", default=0,
+        help="seconds to wait before writing the pidfile")
+    parser.add_option("--stop-delay", type="float", default=0,
+        help="seconds to wait before exiting when asked to stop")
+    parser.add_option("--fail-rate", type="float", default=0,
+        help="chance, between 0 and 1, that starting fails")
+    options, args = parser.parse_args()
+
+    if len(args) != 2:
+        print >>sys.stderr, "%s pidfile (start|stop|restart|fg)" % sys.argv[0]
         return 1
 
-    service = TestService(sys.argv[1])
+    service = TestService(args[0], ignore_term=options.ignore_term, stop_timeout=options.stop_timeout,
+        start_delay=options.start_delay, stop_delay=options.stop_delay, fail_rate=options.fail_rate)
 
-    if sys.argv[2] == "start":
+    if args[1] == "start":
         return service.start()
-    elif sys.argv[2] == "stop":
+    elif args[1] == "stop":
         return service.stop()
-    elif sys.argv[2] == "restart":
+    elif args[1] == "restart":
         return service.restart()
+    elif args[1] == "fg":
+        return service.foreground()
 
     print >>sys.stderr, "Unknown command"
     return 2
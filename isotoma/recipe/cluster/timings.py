@@ -0,0 +1,157 @@
+# Copyright 2010 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Timing each phase of starting and stopping services, and keeping a history of them """
+
+import os, time, math
+
+
+def json_module():
+    """ I import json when it is first needed, it is slow to import """
+    try:
+        import simplejson as json
+    except ImportError:
+        import json
+    return json
+
+
+class Timer(object):
+
+    """ I time the phases of an action on a service.
+
+    Use me as a context manager; each call to mark ends a phase. When the block exits the
+    finished record is passed to record, marked as failed if the block raised """
+
+    def __init__(self, service, action, record):
+        self.service = service
+        self.action = action
+        self.record = record
+        self.phases = []
+
+    def __enter__(self):
+        self.started = self.last = time.time()
+        return self
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases.append((phase, round(now - self.last, 4)))
+        self.last = now
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.record({
+            "service": self.service,
+            "action": self.action,
+            "time": round(self.started, 3),
+            "total": round(time.time() - self.started, 4),
+            "phases": self.phases,
+            "ok": exc_type is None,
+            })
+        return False
+
+
+def format_timing(timing):
+    phases = ", ".join("%s=%.3fs" % (phase, duration) for phase, duration in timing["phases"])
+    status = "" if timing["ok"] else " (failed)"
+    return "%s %s took %.3fs%s: %s" % (timing["service"], timing["action"], timing["total"], status, phases)
+
+
+# How big the timings history may grow before the oldest half of it is dropped
+MAX_HISTORY_SIZE = 1024 * 1024
+
+
+class History(object):
+
+    """ I am a file of timings, one JSON object per line.
+
+    Once the file passes max_size I keep only the newest timings that fit in half of
+    it, so reading it stays cheap however long the cluster has been running """
+
+    def __init__(self, path, max_size=MAX_HISTORY_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    def append(self, timings):
+        if not timings:
+            return
+        json = json_module()
+        data = "".join(json.dumps(timing, sort_keys=True) + "\n" for timing in timings)
+        fp = open(self.path, "a")
+        try:
+            fp.write(data)
+            size = fp.tell()
+        finally:
+            fp.close()
+        if size > self.max_size:
+            self.trim()
+
+    def trim(self):
+        """ I drop the oldest timings, keeping the newest that fit in half of max_size """
+        lines = open(self.path).readlines()
+        kept = []
+        size = 0
+        for line in reversed(lines):
+            size += len(line)
+            if size > self.max_size / 2:
+                break
+            kept.append(line)
+        kept.reverse()
+
+        # Write the new history beside the old one, so readers never see half of it
+        temp = "%s.%d" % (self.path, os.getpid())
+        fp = open(temp, "w")
+        try:
+            fp.writelines(kept)
+        finally:
+            fp.close()
+        os.rename(temp, self.path)
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return []
+        json = json_module()
+        timings = []
+        for line in open(self.path):
+            try:
+                timings.append(json.loads(line))
+            except ValueError:
+                # A write that was cut short
+                continue
+        return timings
+
+
+def percentile(values, p):
+    """ I return the p'th percentile of values using the nearest rank method """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = max(1, int(math.ceil(p / 100.0 * len(values))))
+    return values[min(rank, len(values)) - 1]
+
+
+def summarise(timings):
+    """ I return count, p50, p95 and max of the total time of successful actions, keyed by (service, action) """
+    totals = {}
+    for timing in timings:
+        if timing.get("ok"):
+            totals.setdefault((timing["service"], timing["action"]), []).append(timing["total"])
+
+    summary = {}
+    for key, values in totals.items():
+        summary[key] = {
+            "count": len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "max": max(values),
+            }
+    return summary